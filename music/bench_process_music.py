@@ -0,0 +1,126 @@
+#! /usr/bin/python
+
+# Benchmarks for the hot paths of process_music.py
+# Run e.g. `python bench_process_music.py split --chunks 30` and compare the numbers between modes
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import ffmpeg
+
+import process_music as PM
+
+def timed(fn, *args, repeat=1):
+  best = float('inf')
+  for _ in range(repeat):
+    begin = time.perf_counter()
+    fn(*args)
+    best = min(best, time.perf_counter() - begin)
+  return best
+
+def make_test_audio(path: str, duration: float):
+  # A sine wave is good enough, we only care about container/demuxer overhead
+  stream = ffmpeg.input(f"sine=frequency=440:duration={duration}", f='lavfi')
+  stream = ffmpeg.output(stream, path, acodec='libopus')
+  stream = ffmpeg.overwrite_output(stream)
+  PM.run_ffmpeg(stream)
+
+def bench_split(args):
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    audio_filepath = args.input
+    if audio_filepath is None:
+      audio_filepath = os.path.join(tmp_dir, 'input.ogg')
+      print(f"-- Generating {args.duration}s of test audio")
+      make_test_audio(audio_filepath, args.duration)
+    duration = float(ffmpeg.probe(audio_filepath)['format']['duration'])
+    _, ext = os.path.splitext(audio_filepath)
+
+    chunk_len = duration / args.chunks
+    for mode, split_fn in PM.SPLIT_MODES.items():
+      out_dir = os.path.join(tmp_dir, mode)
+      os.makedirs(out_dir)
+      cuts = [(os.path.join(out_dir, f"{i}{ext}"), i * chunk_len, (i + 1) * chunk_len)
+              for i in range(args.chunks)]
+      elapsed = timed(split_fn, audio_filepath, cuts, lambda cut: None, repeat=args.repeat)
+      print(f"{mode:>12}: {elapsed:8.3f}s for {args.chunks} chunks")
+      shutil.rmtree(out_dir)
+
+def write_command_files(lines_path: str, yaml_path: str, num_chunks: int, chunks_per_job: int):
+  with open(lines_path, 'w') as lines_file, open(yaml_path, 'w') as yaml_file:
+    for job_idx in range(0, num_chunks, chunks_per_job):
+      if job_idx > 0:
+        lines_file.write('---\n')
+        yaml_file.write('---\n')
+      url = f"https://www.youtube.com/watch?v=bench{job_idx:06}"
+      lines_file.write(f"url: {url}\nprefix: \"{{index}}. \"\nXtag(artist,composer): \"Someone\"\nXtag(tracknumber): $INDEX\n")
+      yaml_file.write(f"url: \"{url}\"\nprefix: \"{{index}}. \"\ntags:\n- type: artist,composer\n  value: \"Someone\"\n- type: tracknumber\n  value:\n    macro: $INDEX\nchunks:\n")
+      for i in range(min(chunks_per_job, num_chunks - job_idx)):
+        begin = PM.MU.strformat_seconds(i * 60)
+        lines_file.write(f"chunk: {begin} NEXTCHUNK Movement {i}\n^tag(comment): \"Comment {i}\"\n")
+        yaml_file.write(f"- filename: \"Movement {i}\"\n  segment: \"{begin} NEXTCHUNK\"\n  tags:\n  - type: comment\n    value: \"Comment {i}\"\n")
+
+def bench_parse(args):
+  import yaml
+  print(f"-- PyYAML C loader {'available' if hasattr(yaml, 'CSafeLoader') else 'NOT available, YAML uses the pure Python loader'}")
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    lines_path = os.path.join(tmp_dir, 'input.txt')
+    yaml_path = os.path.join(tmp_dir, 'input.yml')
+    write_command_files(lines_path, yaml_path, args.chunks, args.chunks_per_job)
+
+    def parse(parse_fn, path):
+      with open(path, 'r') as f:
+        for _ in parse_fn(f, path):
+          pass
+
+    for name, parse_fn, path in [('lines', PM.iter_input_file, lines_path), ('yaml', PM.iter_input_file_yaml, yaml_path)]:
+      elapsed = timed(parse, parse_fn, path, repeat=args.repeat)
+      print(f"{name:>12}: {elapsed:8.3f}s for {args.chunks} chunks ({os.path.getsize(path) // 1024} KiB)")
+
+def bench_memory(args):
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, 'input.txt')
+    # Playlist-like: long sections of chunks sharing S-scoped tags
+    with open(path, 'w') as f:
+      for i in range(args.chunks):
+        if i > 0 and i % args.section_size == 0:
+          f.write('Stag(album,albumartist,artist,composer): "Some album"\n$$--SECTION BREAK--$$\n')
+        f.write(f"chunk: {PM.MU.strformat_seconds(i * 60)} NEXTCHUNK Chapter {i}\n")
+      f.write('Stag(album,albumartist,artist,composer): "Some album"\n')
+      f.write('url: https://www.youtube.com/playlist?list=bench\n')
+
+    tracemalloc.start()
+    with open(path, 'r') as f:
+      input_struct = PM.parse_input_file(f, path)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    num_chunks = sum(len(job.chunks) for job in input_struct.job_list)
+    print(f"{num_chunks} chunks: {current / 1024 / 1024:.2f} MiB retained ({current / num_chunks:.0f} B/chunk), {peak / 1024 / 1024:.2f} MiB peak")
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='bench_process_music.py')
+  subparsers = parser.add_subparsers(dest='subparser_name', required=True)
+
+  subparser_split = subparsers.add_parser('split', help='Compare the chunk splitting modes.')
+  subparser_split.add_argument('--input', help='Audio file to split. Omit to generate a test file.')
+  subparser_split.add_argument('--duration', type=float, default=3600, help='Length in seconds of the generated test file.')
+  subparser_split.add_argument('--chunks', type=int, default=30)
+  subparser_split.add_argument('--repeat', type=int, default=3)
+  subparser_split.set_defaults(func=bench_split)
+
+  subparser_parse = subparsers.add_parser('parse', help='Compare the line based and YAML command file parsers.')
+  subparser_parse.add_argument('--chunks', type=int, default=10000)
+  subparser_parse.add_argument('--chunks-per-job', type=int, default=100)
+  subparser_parse.add_argument('--repeat', type=int, default=3)
+  subparser_parse.set_defaults(func=bench_parse)
+
+  subparser_memory = subparsers.add_parser('memory', help='Measure the memory footprint of a parsed command file.')
+  subparser_memory.add_argument('--chunks', type=int, default=10000)
+  subparser_memory.add_argument('--section-size', type=int, default=100)
+  subparser_memory.set_defaults(func=bench_memory)
+
+  args = parser.parse_args()
+  args.func(args)
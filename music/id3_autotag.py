@@ -1,19 +1,29 @@
 #! /usr/bin/python
 
 import os
+import sys
 import subprocess
-import glob
+import time
 import re
 import shutil
 import argparse
-import music_tag
+import contextlib
+import concurrent.futures
+from dataclasses import dataclass
 from typing import Optional, Tuple
 
 import my_utils as MU
 import my_vipe as MVipe
+import my_tagging as MT
+import my_tagindex as MTI
 
 MUSIC_EXTS = ['mp3', 'm4a', 'flac', 'alac', 'wav', 'ogg', 'opus']
-MUSIC_EXT_STRIPPER = MU.file_ext_stripper(set(MUSIC_EXTS))
+MUSIC_EXT_SET = set(MUSIC_EXTS)
+MUSIC_EXT_STRIPPER = MU.file_ext_stripper(MUSIC_EXT_SET)
+
+# Files whose tag index entries get written in one transaction
+INDEX_BATCH_SIZE = 256
+
 # We want to match the following:
 #   'no. 1' 'No. 1' 'no 1' '1.' '1-' '#1' '#1.' 'no. 1-'
 # but not the following (bare numbers)
@@ -43,66 +53,167 @@ def parse_track_number(s: str) -> Optional[int]:
 def parse_track_name(s: str) -> str:
   return MUSIC_EXT_STRIPPER(TRACK_NUMBER_PATTERN.sub('', s, count=1))
 
-parser = argparse.ArgumentParser(prog='id3_autotag.py')
-parser.add_argument('-D', '--dry-run', action='store_true')
-parser.add_argument('-q', '--quiet', action='store_true')
-parser.add_argument('-r', '--recursive', action='store_true')
-parser.add_argument('--index', default='none', choices=['none', 'smart', 'manual', 'manual+striptitle'])
-parser.add_argument('--strip-ytdlp-id', action='store_true')
-
-args = parser.parse_args()
-
-def my_print(msg):
-  if not args.quiet:
-    print(msg)
-
-if args.dry_run:
-  my_print('Performing a dry run')
-
-glob_pattern = '**/*' if args.recursive else '*'
-
-music_files = []
-for ext in [f"{glob_pattern}.{s}" for s in MUSIC_EXTS]:
-  music_files.extend(glob.glob(ext, recursive=args.recursive))
-music_files.sort()
-
-if args.index.startswith('manual'):
-  vipe_res = MVipe.vipe('\n'.join(music_files))
-  if vipe_res:
-    manual_index_map = {}
-    for i, line in enumerate(vipe_res.split('\n')):
-      # Skip empty lines or comments
-      if line == '' or line.startswith('#'):
-        continue
-      manual_index_map[line.strip()] = i + 1
-
-for filepath in music_files:
-  if not args.dry_run:
-    f = music_tag.load_file(filepath)
-  else:
-    # Dummy dict
-    f = {}
-
-  if args.index == 'smart':
+def strip_ytdlp_id(title: str) -> tuple[str, Optional[str]]:
+  if res := YTDLP_ID_STRIPPER.search(title):
+    return (YTDLP_ID_STRIPPER.sub('', title), res.group())
+  return (title, None)
+
+@dataclass
+class AutotagTask():
+  filepath: str
+  index_mode: str
+  # Track number the user assigned in manual mode, if any
+  manual_index: Optional[int]
+  strip_ytdlp_id: bool
+  dry_run: bool
+  # Tags as known from the tag index, if it's used
+  current: Optional[dict[str, str]] = None
+  # The file isn't (or no longer) in the tag index, read its indexed tags here and hand them back to be stored
+  read_for_index: bool = False
+
+@dataclass
+class AutotagResult():
+  messages: list[str]
+  write: MT.TagWriteResult
+  # The tags read for the tag index, if asked to
+  read: Optional[MT.TagReadResult] = None
+
+def autotag_file(task: AutotagTask) -> AutotagResult:
+  # Runs in the worker processes, hence messages are collected and printed by the main process
+  messages = []
+  filepath = task.filepath
+  tags = {}
+
+  if task.index_mode == 'smart':
     filename = os.path.basename(filepath)
     index = parse_track_number(filename)
     if index is not None:
       track_name = parse_track_name(filename)
-      my_print(f"{filepath}: Assigning track number {index}, name '{track_name}'")
-      f['tracknumber'] = index
-      f['tracktitle'] = track_name
-  elif args.index.startswith('manual'):
-    if index := manual_index_map.get(filepath):
+      messages.append(f"{filepath}: Assigning track number {index}, name '{track_name}'")
+      tags['tracknumber'] = index
+      tags['tracktitle'] = track_name
+  elif task.index_mode.startswith('manual'):
+    if index := task.manual_index:
       filename = os.path.basename(filepath)
-      track_name = parse_track_name(filename) if args.index.endswith('+striptitle') else MUSIC_EXT_STRIPPER(filename)
-      my_print(f"{filepath}: User assigned track number {index}, name '{track_name}'")
-      f['tracknumber'] = index
-      f['tracktitle'] = track_name
-
-  if args.strip_ytdlp_id:
-    orig_title = str(f['tracktitle'])
-    my_print(f"{filepath}: Stripped '{YTDLP_ID_STRIPPER.search(orig_title).group()}'")
-    f['tracktitle'] = YTDLP_ID_STRIPPER.sub('', orig_title)
-
-  if not args.dry_run:
-    f.save()
+      track_name = parse_track_name(filename) if task.index_mode.endswith('+striptitle') else MUSIC_EXT_STRIPPER(filename)
+      messages.append(f"{filepath}: User assigned track number {index}, name '{track_name}'")
+      tags['tracknumber'] = index
+      tags['tracktitle'] = track_name
+
+  # Derived from the indexed tags first, then again from the file if it needs to be written
+  stripped_ids = []
+  def derive_stripped_title(f, tags):
+    title, stripped = strip_ytdlp_id(str(tags.get('tracktitle', f['tracktitle'])))
+    stripped_ids.append(stripped)
+    return {'tracktitle': title}
+
+  current = task.current
+  read = None
+  if task.read_for_index:
+    # Read once here, then files that already have the desired tags don't get loaded a second time for writing
+    read = MT.read_tags(filepath, MTI.INDEXED_TAGS)
+    current = read.tags
+
+  write = MT.TagWrite(filepath, tags, derive=derive_stripped_title if task.strip_ytdlp_id else None, current=current)
+  # In a dry run without the tag index, files are still read to tell what would change, they just aren't saved
+  result = MT.write_tags(write, task.dry_run)
+  if stripped_ids and stripped_ids[-1] is not None:
+    messages.append(f"{filepath}: Stripped '{stripped_ids[-1]}'")
+  return AutotagResult(messages=messages, write=result, read=read)
+
+def main():
+  parser = argparse.ArgumentParser(prog='id3_autotag.py')
+  parser.add_argument('-D', '--dry-run', action='store_true')
+  parser.add_argument('-q', '--quiet', action='store_true')
+  parser.add_argument('-r', '--recursive', action='store_true')
+  parser.add_argument('--index', default='none', choices=['none', 'smart', 'manual', 'manual+striptitle'])
+  parser.add_argument('--strip-ytdlp-id', action='store_true')
+  parser.add_argument('--modified-within', type=float, metavar='DAYS', help='Only process files modified in the last DAYS days.')
+  parser.add_argument('--tag-index', default=MTI.DEFAULT_INDEX_PATH, help='SQLite database of the tags of files already seen, so that unchanged files aren\'t opened again.')
+  parser.add_argument('--no-tag-index', action='store_true', help='Read every file, without using nor updating --tag-index.')
+  parser.add_argument('--list-missing', metavar='TAG', choices=MTI.INDEXED_TAGS, help='Only list the files without TAG, according to the tag index.')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes to load, parse and save files with. 1 does everything in this process.')
+
+  args = parser.parse_args()
+
+  def my_print(msg):
+    if not args.quiet:
+      print(msg)
+
+  if args.dry_run:
+    my_print('Performing a dry run')
+
+  min_mtime = time.time() - args.modified_within * 24 * 3600 if args.modified_within is not None else None
+  # One walk for all extensions
+  music_files = list(MU.iter_files_with_ext('.', MUSIC_EXT_SET, recursive=args.recursive, min_mtime=min_mtime))
+
+  manual_index_map = {}
+  if args.index.startswith('manual'):
+    vipe_res = MVipe.vipe('\n'.join(music_files))
+    if vipe_res:
+      for i, line in enumerate(vipe_res.split('\n')):
+        # Skip empty lines or comments
+        if line == '' or line.startswith('#'):
+          continue
+        manual_index_map[line.strip()] = i + 1
+
+  with contextlib.ExitStack() as stack:
+    index = None if args.no_tag_index else stack.enter_context(MTI.TagIndex(args.tag_index))
+
+    if args.list_missing is not None:
+      if index is None:
+        print('Error: --list-missing needs the tag index')
+        sys.exit(-1)
+      index.refresh(music_files)
+      for filepath in index.missing(args.list_missing, music_files):
+        print(filepath)
+      return
+
+    # Outdated files are left to the workers to read, instead of getting parsed here first and then again there
+    current_tags, outdated = index.lookup(music_files) if index is not None else ({}, [])
+    outdated_stats = dict(outdated)
+    if index is not None:
+      music_files = [filepath for filepath in music_files if filepath in current_tags or filepath in outdated_stats]
+
+    tasks = [
+      AutotagTask(filepath, args.index, manual_index_map.get(filepath), args.strip_ytdlp_id, args.dry_run,
+                  current_tags.get(filepath), read_for_index=filepath in outdated_stats)
+      for filepath in music_files]
+
+    if args.jobs > 1:
+      executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs))
+      # Results come back in order, as soon as each one (and the ones before it) is done
+      results = executor.map(autotag_file, tasks, chunksize=16)
+    else:
+      results = map(autotag_file, tasks)
+
+    num_changed = 0
+    # Index writes go out in batches, a transaction per file would cost more than the tagging itself
+    read_entries = []
+    written = []
+    def flush_index():
+      # Reads first, a file's write gets merged into what was read from it
+      index.store(read_entries)
+      index.update(written)
+      read_entries.clear()
+      written.clear()
+
+    for result in results:
+      for msg in result.messages:
+        my_print(msg)
+      if result.read is not None and result.read.error is None:
+        read_entries.append((result.read.path, outdated_stats[result.read.path], result.read.tags))
+      if result.write.error is not None:
+        print(f"{result.write.path}: Error: {result.write.error!r}")
+      elif result.write.changed:
+        num_changed += 1
+        if index is not None and not args.dry_run:
+          written.append((result.write.path, {name: new for name, (_, new) in result.write.changed.items()}))
+      if len(read_entries) + len(written) >= INDEX_BATCH_SIZE:
+        flush_index()
+    if index is not None:
+      flush_index()
+  my_print(f"{num_changed} of {len(tasks)} files {'would be ' if args.dry_run else ''}changed")
+
+if __name__ == '__main__':
+  main()
@@ -5,9 +5,10 @@ import sys
 import re
 import itertools
 import argparse
-import music_tag
 
 import my_vipe as MVipe
+import my_tagging as MT
+import my_tagindex as MTI
 
 # get list of files from stdin
 # write them into a table as a text file, with columns filled with current tag values (specified with --tags=xxx,yyy,zzz)
@@ -16,6 +17,8 @@ import my_vipe as MVipe
 
 parser = argparse.ArgumentParser(prog='id3_batchedit.py')
 parser.add_argument('tags')
+parser.add_argument('--no-tag-index', action='store_true', help='Read the tags from the files themselves, without using nor updating --tag-index.')
+parser.add_argument('--tag-index', default=MTI.DEFAULT_INDEX_PATH, help='SQLite database of the tags of files already seen, so that unchanged files aren\'t opened again.')
 args = parser.parse_args()
 
 VALID_ID3_TAG_LIST = ['tracktitle', 'tracknumber', 'artist', 'albumartist', 'composer', 'album', 'comment']
@@ -38,25 +41,48 @@ if not validate_tags(tags_name):
   sys.exit(-1)
 
 files_path = [f.strip() for f in sys.stdin]
-files_tags = [music_tag.load_file(path) for path in files_path]
+if args.no_tag_index:
+  index = None
+  # Only the requested columns are kept, not the whole loaded files
+  current_tags = {}
+  for result in MT.read_tags_batch(files_path, tags_name):
+    if result.error is not None:
+      print(f"{result.path}: Error: {result.error!r}")
+    else:
+      current_tags[result.path] = result.tags
+else:
+  index = MTI.TagIndex(args.tag_index)
+  # Only files that changed since they were last seen get opened
+  current_tags = index.refresh(files_path)
+files_path = [path for path in files_path if path in current_tags]
+files_tags = [current_tags[path] for path in files_path]
 
-original_rows = itertools.chain.from_iterable([
+original_text = MVipe.format_table_data(['ID'] + tags_name, itertools.chain.from_iterable([
   (f"# File: {file_path}",
    [str(idx)] + [str(file_tags[tag_name]) for tag_name in tags_name])
-  for idx, (file_tags, file_path) in enumerate(zip(files_tags, files_path))])
+  for idx, (file_tags, file_path) in enumerate(zip(files_tags, files_path))]))
+# Split on single tabs, so that an empty cell doesn't merge into the delimiter and shift the cells after it onto
+# the wrong tag
+original_rows = {row[0]: row for row in MVipe.parse_table_data(original_text, merge_tabs=False)}
 
-if vipe_res := MVipe.vipe(MVipe.format_table_data(['ID'] + tags_name, original_rows), syntax_hint='csv'):
-  directives, edited_rows = MVipe.parse_table_data(vipe_res, advanced=True)
+if vipe_res := MVipe.vipe(original_text, syntax_hint='csv'):
+  directives, edited_rows = MVipe.parse_table_data(vipe_res, advanced=True, merge_tabs=False)
 
   constants = {}
   for d in directives:
-    var_name, value = d.split('=', maxcount=1)
+    var_name, value = d.split('=', maxsplit=1)
     constants[var_name.strip()] = value.strip()
 
+  writes = []
   for idx, row in enumerate(edited_rows):
-    f = files_tags[int(row[0])]
+    file_idx = int(row[0])
+    original_row = original_rows.get(row[0], [])
+    tags = {}
+    for col, (tag, value) in enumerate(zip(tags_name, row[1:]), start=1):
+      # Only cells that were edited get written, the rest of the row is left to whatever the file has
+      if col < len(original_row) and value == original_row[col]:
+        continue
 
-    for tag, value in zip(tags_name, row[1:]):
       if tag == 'tracknumber':
         if value == 'i':
           value = idx
@@ -66,8 +92,25 @@ if vipe_res := MVipe.vipe(MVipe.format_table_data(['ID'] + tags_name, original_r
       if value == '*':
         value = constants[tag]
 
-      f[tag] = value
-
-    f.save()
+      tags[tag] = value
+    if tags:
+      writes.append(MT.TagWrite(files_path[file_idx], tags, current=files_tags[file_idx]))
+
+  num_changed = 0
+  written = []
+  for result in MT.write_tags_batch(writes):
+    if result.error is not None:
+      print(f"{result.path}: Error: {result.error!r}")
+    elif result.changed:
+      num_changed += 1
+      for name, (old, new) in result.changed.items():
+        print(f"{result.path}: {name}: '{old}' -> '{new}'")
+      written.append((result.path, {name: new for name, (_, new) in result.changed.items()}))
+  if index is not None:
+    index.update(written)
+  print(f"{num_changed} of {len(files_path)} files changed")
 else:
   print("Nothing changed. Exiting.")
+
+if index is not None:
+  index.close()
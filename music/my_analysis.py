@@ -0,0 +1,273 @@
+# Audio analysis of whole videos: the gaps (silence, applause) between the pieces of e.g. a concert, and the
+# loudness of each piece.
+#
+# ffmpeg decodes the audio into a pipe, which is read back in fixed size blocks and reduced to a few numbers per
+# frame right away. Memory stays bounded no matter the length of the video: a 2 hour concert ends up as a few
+# hundred thousand floats.
+#
+# Needs numpy, which is why process_music.py only imports this module when it's asked to analyze.
+
+from typing import Iterator, Optional
+from dataclasses import dataclass
+
+import ffmpeg
+import numpy as np
+
+SAMPLE_RATE = 16000
+FRAME_SECONDS = 0.05
+# Frames decoded and analyzed at once, i.e. a minute of audio
+BLOCK_FRAMES = 1200
+
+# Gap frames are quieter than the threshold given to find_gaps(), or noise-like enough to be applause
+APPLAUSE_FLATNESS = 0.4
+MIN_GAP_SECONDS = 1.0
+MIN_CHUNK_SECONDS = 30.0
+
+# Part of the analysis fingerprint, bump whenever the results of the functions below change
+ANALYSIS_VERSION = 1
+
+@dataclass
+class Envelope():
+  frame_seconds: float
+  # Per frame: loudness in dBFS
+  rms_db: np.ndarray
+  # Per frame: how much the spectrum grew since the previous frame, high on onsets such as claps
+  flux: np.ndarray
+  # Per frame: 0 for a pure tone, 1 for white noise
+  flatness: np.ndarray
+
+def pipe_pcm(stream, block_samples: int, channels: int, **output_args) -> Iterator[np.ndarray]:
+  """Run the ffmpeg stream into a pipe, as blocks of float32 samples (interleaved if there's more than one channel)."""
+  process = (
+    stream
+    .output('pipe:', format='f32le', **output_args)
+    .global_args('-loglevel', 'error')
+    .run_async(pipe_stdout=True))
+  finished = False
+  try:
+    block_bytes = block_samples * channels * 4
+    while data := process.stdout.read(block_bytes):
+      yield np.frombuffer(data, dtype=np.float32)
+    finished = True
+  finally:
+    process.stdout.close()
+    if not finished:
+      # The reader stopped early, don't leave ffmpeg blocked on a full pipe
+      process.kill()
+    if process.wait() != 0 and finished:
+      raise RuntimeError(f"ffmpeg failed to decode {stream}")
+
+def stream_pcm(path: str, block_samples: int, sample_rate: int = SAMPLE_RATE, channels: int = 1) -> Iterator[np.ndarray]:
+  return pipe_pcm(ffmpeg.input(path), block_samples, channels, ac=channels, ar=sample_rate)
+
+def compute_envelope(path: str) -> Envelope:
+  frame_len = int(SAMPLE_RATE * FRAME_SECONDS)
+  window = np.hanning(frame_len).astype(np.float32)
+  rms_parts = []
+  flux_parts = []
+  flatness_parts = []
+  prev_spectrum = None
+  for block in stream_pcm(path, frame_len * BLOCK_FRAMES):
+    # Blocks are a whole number of frames, except for the last one whose partial frame is dropped
+    num_frames = block.size // frame_len
+    if num_frames == 0:
+      continue
+    frames = block[:num_frames * frame_len].reshape(num_frames, frame_len)
+
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    rms_parts.append(20 * np.log10(np.maximum(rms, 1e-10)))
+
+    spectrum = np.abs(np.fft.rfft(frames * window, axis=1))
+    power = np.square(spectrum) + 1e-12
+    flatness_parts.append(np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1))
+
+    # The first frame of a block is compared against the last one of the previous block
+    prev = spectrum[:1] if prev_spectrum is None else prev_spectrum
+    flux_parts.append(np.sum(np.maximum(np.diff(np.vstack((prev, spectrum)), axis=0), 0), axis=1))
+    prev_spectrum = spectrum[-1:]
+
+  def join(parts: list[np.ndarray]) -> np.ndarray:
+    return np.concatenate(parts) if parts else np.empty(0)
+  return Envelope(frame_seconds=FRAME_SECONDS, rms_db=join(rms_parts), flux=join(flux_parts), flatness=join(flatness_parts))
+
+def find_gaps(envelope: Envelope, gap_db: float, min_gap_seconds: float = MIN_GAP_SECONDS) -> list[tuple[float, float]]:
+  """Time ranges, in seconds, of the silence and applause long enough to be between two pieces."""
+  quiet = envelope.rms_db < gap_db
+  # Applause is noise made of many onsets, steady noise such as hiss is quiet anyway
+  applause = (envelope.flatness > APPLAUSE_FLATNESS) & (envelope.flux > np.median(envelope.flux)) if envelope.flux.size else quiet
+  mask = np.concatenate(([0], (quiet | applause).astype(np.int8), [0]))
+  edges = np.diff(mask)
+  starts = np.flatnonzero(edges == 1)
+  ends = np.flatnonzero(edges == -1)
+  keep = (ends - starts) * envelope.frame_seconds >= min_gap_seconds
+  return [(round(float(start * envelope.frame_seconds), 3), round(float(end * envelope.frame_seconds), 3))
+          for start, end in zip(starts[keep], ends[keep])]
+
+def snap_time(time: float, gaps: list[tuple[float, float]], max_shift: float, is_begin: bool) -> float:
+  """Move time to the nearest gap within max_shift seconds, if any.
+
+  Beginnings of chunks snap to where a gap ends, and ends to where one
+  begins, so that the gap itself is left out of the chunks on both sides.
+  """
+  best = time
+  best_shift = max_shift
+  for gap_start, gap_end in gaps:
+    candidate = gap_end if is_begin else gap_start
+    shift = abs(candidate - time)
+    if shift <= best_shift:
+      best = candidate
+      best_shift = shift
+  return best
+
+def propose_chunks(gaps: list[tuple[float, float]], duration: float, min_chunk_seconds: float = MIN_CHUNK_SECONDS) -> list[tuple[float, float]]:
+  """The stretches of audio between gaps, long enough to be pieces of their own."""
+  chunks = []
+  begin = 0.0
+  for gap_start, gap_end in [*gaps, (duration, duration)]:
+    if gap_start - begin >= min_chunk_seconds:
+      chunks.append((begin, gap_start))
+    begin = gap_end
+  return chunks
+
+# Loudness per ITU-R BS.1770 (EBU R128), for ReplayGain 2.0 tags
+
+LOUDNESS_SAMPLE_RATE = 48000
+# K-weighting at 48 kHz, as the coefficients of two ffmpeg biquad filters: a high shelf, then a high pass
+K_WEIGHTING = [
+  {'b0': 1.53512485958697, 'b1': -2.69169618940638, 'b2': 1.19839281085285, 'a0': 1.0, 'a1': -1.69065929318241, 'a2': 0.73248077421585},
+  {'b0': 1.0, 'b1': -2.0, 'b2': 1.0, 'a0': 1.0, 'a1': -1.99004745483398, 'a2': 0.99007225036621},
+]
+# Gating blocks are 400ms long and start every 100ms, i.e. each one is 4 segments
+SEGMENT_SECONDS = 0.1
+BLOCK_SEGMENTS = 4
+# Segments decoded and measured at once, i.e. a minute of audio
+PIPE_SEGMENTS = 600
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+REPLAYGAIN_REFERENCE = -18.0
+
+# Channels of ffmpeg's common layouts, in the order they come out of the decoder
+LAYOUT_CHANNELS = {
+  'mono': ['FC'],
+  'stereo': ['FL', 'FR'],
+  '2.1': ['FL', 'FR', 'LFE'],
+  '3.0': ['FL', 'FR', 'FC'],
+  '3.0(back)': ['FL', 'FR', 'BC'],
+  '4.0': ['FL', 'FR', 'FC', 'BC'],
+  'quad': ['FL', 'FR', 'BL', 'BR'],
+  'quad(side)': ['FL', 'FR', 'SL', 'SR'],
+  '3.1': ['FL', 'FR', 'FC', 'LFE'],
+  '5.0': ['FL', 'FR', 'FC', 'BL', 'BR'],
+  '5.0(side)': ['FL', 'FR', 'FC', 'SL', 'SR'],
+  '4.1': ['FL', 'FR', 'FC', 'LFE', 'BC'],
+  '5.1': ['FL', 'FR', 'FC', 'LFE', 'BL', 'BR'],
+  '5.1(side)': ['FL', 'FR', 'FC', 'LFE', 'SL', 'SR'],
+  '6.0': ['FL', 'FR', 'FC', 'BC', 'SL', 'SR'],
+  '6.1': ['FL', 'FR', 'FC', 'LFE', 'BC', 'SL', 'SR'],
+  '7.0': ['FL', 'FR', 'FC', 'BL', 'BR', 'SL', 'SR'],
+  '7.1': ['FL', 'FR', 'FC', 'LFE', 'BL', 'BR', 'SL', 'SR'],
+  '7.1(wide)': ['FL', 'FR', 'FC', 'LFE', 'BL', 'BR', 'FLC', 'FRC'],
+  '7.1(wide-side)': ['FL', 'FR', 'FC', 'LFE', 'FLC', 'FRC', 'SL', 'SR'],
+}
+# BS.1770 channel weights: front channels count as is, surround ones +1.5 dB, and LFE not at all
+FRONT_CHANNELS = {'FL', 'FR', 'FC', 'FLC', 'FRC'}
+SURROUND_WEIGHT = 1.41
+
+# Part of the loudness fingerprint, bump whenever the results of the functions below change
+LOUDNESS_VERSION = 2
+
+@dataclass
+class LoudnessProfile():
+  segment_seconds: float
+  # Per segment: mean square of the K-weighted audio, summed over the channels with their BS.1770 weights
+  power: np.ndarray
+  # Per segment: sample peak of the audio as is
+  peak: np.ndarray
+
+  def segment_range(self, begin_time: float, end_time: Optional[float]) -> slice:
+    end = self.power.size if end_time is None else int(round(end_time / self.segment_seconds))
+    return slice(int(round(begin_time / self.segment_seconds)), end)
+
+def channel_weights(channels: int, layout: Optional[str]) -> np.ndarray:
+  names = LAYOUT_CHANNELS.get(layout or '')
+  if names is None or len(names) != channels:
+    # Unknown layout, count every channel as a front one
+    return np.ones(channels)
+  return np.array([1.0 if name in FRONT_CHANNELS else 0.0 if name.startswith('LFE') else SURROUND_WEIGHT for name in names])
+
+def compute_loudness_profile(path: str) -> LoudnessProfile:
+  """Measure the whole file with a single decode.
+
+  The audio is kept in its own channel layout, since up- or downmixing it
+  changes the loudness (a mono track upmixed to stereo reads 3 dB louder).
+  The decoded audio is split inside ffmpeg: one copy gets K-weighted, and both
+  come out through the same pipe as a stream of twice the channels, the
+  weighted ones first.
+  """
+  stream_info = ffmpeg.probe(path, select_streams='a:0')['streams'][0]
+  channels = int(stream_info['channels'])
+  weights = channel_weights(channels, stream_info.get('channel_layout'))
+
+  audio = ffmpeg.input(path).audio.filter('aresample', LOUDNESS_SAMPLE_RATE).filter('aformat', sample_fmts='flt')
+  branches = audio.filter_multi_output('asplit', 2)
+  weighted = branches[0]
+  for coeffs in K_WEIGHTING:
+    weighted = weighted.filter('biquad', **coeffs)
+  merged = ffmpeg.filter([weighted, branches[1]], 'amerge', inputs=2)
+
+  segment_len = int(LOUDNESS_SAMPLE_RATE * SEGMENT_SECONDS)
+  merged_channels = channels * 2
+  power_parts = []
+  peak_parts = []
+  for block in pipe_pcm(merged, segment_len * PIPE_SEGMENTS, channels=merged_channels):
+    num_segments = block.size // (segment_len * merged_channels)
+    if num_segments == 0:
+      continue
+    segments = block[:num_segments * segment_len * merged_channels].reshape(num_segments, segment_len, merged_channels)
+    power_parts.append(np.mean(np.square(segments[:, :, :channels], dtype=np.float64), axis=1) @ weights)
+    peak_parts.append(np.max(np.abs(segments[:, :, channels:]), axis=(1, 2)))
+
+  def join(parts: list[np.ndarray]) -> np.ndarray:
+    return np.concatenate(parts) if parts else np.empty(0)
+  return LoudnessProfile(segment_seconds=SEGMENT_SECONDS, power=join(power_parts), peak=join(peak_parts))
+
+def gating_blocks(power: np.ndarray) -> np.ndarray:
+  if power.size < BLOCK_SEGMENTS:
+    # Shorter than a single block, measure what there is
+    return power[:1] if power.size == 0 else np.array([np.mean(power)])
+  return np.convolve(power, np.full(BLOCK_SEGMENTS, 1 / BLOCK_SEGMENTS), mode='valid')
+
+def block_loudness(power):
+  return -0.691 + 10 * np.log10(np.maximum(power, 1e-20))
+
+def gated_loudness(blocks: np.ndarray) -> Optional[float]:
+  """Integrated loudness in LUFS, None for (near) silence."""
+  blocks = blocks[block_loudness(blocks) > ABSOLUTE_GATE]
+  if blocks.size == 0:
+    return None
+  threshold = block_loudness(np.mean(blocks)) + RELATIVE_GATE
+  blocks = blocks[block_loudness(blocks) > threshold]
+  return float(block_loudness(np.mean(blocks)))
+
+def gain_tags(scope: str, loudness: Optional[float], peak: float) -> dict[str, str]:
+  if loudness is None:
+    return {}
+  return {
+    f"REPLAYGAIN_{scope}_GAIN": f"{REPLAYGAIN_REFERENCE - loudness:.2f} dB",
+    f"REPLAYGAIN_{scope}_PEAK": f"{peak:.6f}",
+  }
+
+def replaygain_tags(profile: LoudnessProfile, ranges: list[tuple[float, Optional[float]]]) -> list[dict[str, str]]:
+  """Track and album ReplayGain tags for each (begin, end) time range, the album being all of the ranges."""
+  track_tags = []
+  album_blocks = []
+  album_peak = 0.0
+  for begin_time, end_time in ranges:
+    segments = profile.segment_range(begin_time, end_time)
+    blocks = gating_blocks(profile.power[segments])
+    peak = float(np.max(profile.peak[segments], initial=0.0))
+    album_blocks.append(blocks)
+    album_peak = max(album_peak, peak)
+    track_tags.append(gain_tags('TRACK', gated_loudness(blocks), peak))
+  album_tags = gain_tags('ALBUM', gated_loudness(np.concatenate(album_blocks)), album_peak) if album_blocks else {}
+  return [{**tags, **album_tags} for tags in track_tags]
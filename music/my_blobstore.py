@@ -0,0 +1,89 @@
+# Content-addressed store for downloaded audio files.
+#
+# Each blob is named after the video ID and a hash of its content, and gets linked (reflink if the filesystem
+# supports it, hardlink otherwise) into the workspaces and output directories that need it, instead of being
+# copied around.
+
+import os
+import glob
+import errno
+import fcntl
+import shutil
+import hashlib
+from typing import Optional
+
+import my_utils as MU
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def reflink(src: str, dest: str) -> bool:
+  """Copy-on-write clone of src into dest, returns False if the filesystem can't do it."""
+  try:
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+      fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    return True
+  except OSError as e:
+    if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+      raise
+    os.remove(dest)
+    return False
+
+def hash_file(path: str) -> str:
+  with open(path, 'rb') as f:
+    return hashlib.file_digest(f, 'sha256').hexdigest()
+
+class BlobStore():
+  """Blobs are shared by every link pointing to them, and must never be modified in place."""
+
+  def __init__(self, root: str):
+    self.root = root
+    os.makedirs(root, exist_ok=True)
+
+  def _blob_path(self, video_id: str, digest: str, ext: str) -> str:
+    return os.path.join(self.root, f"{MU.format_filename(video_id)}-{digest[:16]}{ext}")
+
+  def find(self, video_id: str) -> Optional[str]:
+    for blob in glob.iglob(os.path.join(glob.escape(self.root), glob.escape(MU.format_filename(video_id)) + '-*')):
+      return blob
+    return None
+
+  def put(self, src: str, video_id: str, move: bool = False) -> str:
+    """Add src to the store and return the blob's path.
+
+    With move, src is consumed. Otherwise it's left alone and reflinked or
+    copied into the store, never hardlinked: src lives outside the store (e.g.
+    a --reuse library) and retagging it must not change the blob.
+    """
+    _, ext = os.path.splitext(src)
+    blob = self._blob_path(video_id, hash_file(src), ext)
+    if os.path.exists(blob):
+      # Already stored, e.g. the same video under a different URL
+      if move:
+        os.remove(src)
+      return blob
+    if move:
+      shutil.move(src, blob)
+    else:
+      self.link(src, blob, allow_hardlink=False)
+    return blob
+
+  def link(self, blob: str, dest: str, allow_hardlink: bool = True):
+    """Make dest point to blob's content, replacing whatever dest was.
+
+    Files that are going to be modified (e.g. tagged) must not be hardlinked,
+    for those pass allow_hardlink=False to fall back to a full copy when the
+    filesystem can't reflink.
+    """
+    if os.path.lexists(dest):
+      os.remove(dest)
+    if reflink(blob, dest):
+      return
+    if allow_hardlink:
+      try:
+        os.link(blob, dest)
+        return
+      except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+          raise
+    shutil.copyfile(blob, dest)
@@ -0,0 +1,101 @@
+# Persistent cache for yt-dlp video info, backed by a single SQLite database.
+#
+# Infos are stored per video ID, and URLs map to video IDs. Playlists are stored as the flat listing yt-dlp
+# produces with `extract_flat`, i.e. only their entries' IDs, URLs and titles. The full info of each entry is
+# cached as a video of its own, under the entry's URL, so every entry expires and gets refreshed on its own.
+
+import json
+import time
+from typing import Iterable, Optional
+from dataclasses import dataclass
+
+import my_sqlite as MSQL
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+  video_id TEXT PRIMARY KEY,
+  info TEXT NOT NULL,
+  fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS urls (
+  url TEXT PRIMARY KEY,
+  video_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_video_id ON urls (video_id);
+CREATE TABLE IF NOT EXISTS playlists (
+  url TEXT PRIMARY KEY,
+  info TEXT NOT NULL,
+  fetched_at REAL NOT NULL
+);
+"""
+
+def is_playlist(info: dict) -> bool:
+  return info.get('_type') == 'playlist'
+
+@dataclass
+class CachedInfo():
+  info: dict
+  # Past the TTL, but still within the stale-while-revalidate window: usable, but should be refreshed in the background
+  stale: bool = False
+
+class VideoInfoCache(MSQL.SqliteStore):
+  """Video info store keyed by both URL and video ID.
+
+  ttl and stale_ttl are in seconds. An info younger than ttl is fresh, one
+  younger than ttl + stale_ttl is stale, anything older is treated as absent.
+  Safe to share between threads.
+  """
+
+  def __init__(self, db_path: str, ttl: float, stale_ttl: float):
+    self.ttl = ttl
+    self.stale_ttl = stale_ttl
+    super().__init__(db_path, SCHEMA)
+
+  def _age_state(self, fetched_at: float, now: float) -> Optional[bool]:
+    """None if expired, otherwise whether the info is stale."""
+    age = now - fetched_at
+    if age <= self.ttl:
+      return False
+    if age <= self.ttl + self.stale_ttl:
+      return True
+    return None
+
+  def get_many(self, urls: Iterable[str]) -> dict[str, CachedInfo]:
+    """Bulk lookup of videos and playlists alike.
+
+    URLs that aren't cached (or are expired) are simply left out of the result.
+    """
+    urls = list(dict.fromkeys(urls))
+    now = time.time()
+    with self._lock:
+      url_rows = self._query_in('SELECT url, video_id FROM urls WHERE url IN ({})', urls)
+      video_rows = self._query_in('SELECT video_id, info, fetched_at FROM videos WHERE video_id IN ({})',
+                                  list({video_id for _, video_id in url_rows}))
+      playlist_rows = self._query_in('SELECT url, info, fetched_at FROM playlists WHERE url IN ({})', urls)
+    videos = {video_id: (info, fetched_at) for video_id, info, fetched_at in video_rows}
+    found = [(url, *videos[video_id]) for url, video_id in url_rows if video_id in videos] + playlist_rows
+
+    result = {}
+    for url, info_json, fetched_at in found:
+      stale = self._age_state(fetched_at, now)
+      if stale is not None:
+        result[url] = CachedInfo(info=json.loads(info_json), stale=stale)
+    return result
+
+  def get(self, url: str) -> Optional[CachedInfo]:
+    return self.get_many([url]).get(url)
+
+  def put(self, url: str, info: dict, fetched_at: Optional[float] = None):
+    """Store a video's full info, or a playlist's flat listing."""
+    if fetched_at is None:
+      fetched_at = time.time()
+    with self._lock, self._db:
+      if is_playlist(info):
+        # yt-dlp might hand out a generator here
+        info = {**info, 'entries': list(info.get('entries') or [])}
+        self._db.execute('INSERT OR REPLACE INTO playlists (url, info, fetched_at) VALUES (?, ?, ?)',
+                         (url, json.dumps(info), fetched_at))
+        return
+      self._db.execute('INSERT OR REPLACE INTO videos (video_id, info, fetched_at) VALUES (?, ?, ?)',
+                       (info['id'], json.dumps(info), fetched_at))
+      self._db.execute('INSERT OR REPLACE INTO urls (url, video_id) VALUES (?, ?)', (url, info['id']))
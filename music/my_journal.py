@@ -0,0 +1,133 @@
+# Checkpoint journal of a job's workspace, and fingerprints of the output files.
+#
+# Each completed step is recorded along with a fingerprint of everything it depended on. A resumed (or
+# repeated) run skips the steps whose fingerprint still matches, and redoes the ones whose inputs changed.
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Optional
+
+import my_utils as MU
+
+def fingerprint(*parts) -> str:
+  return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class Journal():
+  """Safe to share between threads, the jobs of one workspace share its journal."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    try:
+      with open(path, 'r') as f:
+        self.steps: dict[str, dict] = json.load(f)
+    except FileNotFoundError:
+      self.steps = {}
+
+  def _save(self):
+    MU.atomic_write_json(self.path, self.steps)
+
+  def get(self, step: str, fp: str) -> Optional[dict]:
+    """The data recorded with step, if it was completed with the fingerprint fp."""
+    record = self.steps.get(step)
+    if record is None or record['fingerprint'] != fp:
+      return None
+    return record['data']
+
+  def is_done(self, step: str, fp: str) -> bool:
+    return self.get(step, fp) is not None
+
+  def mark_done(self, step: str, fp: str, data: Optional[dict[str, Any]] = None):
+    with self._lock:
+      self.steps[step] = {'fingerprint': fp, 'data': data or {}}
+      self._save()
+
+  def invalidate(self, step: str):
+    with self._lock:
+      if self.steps.pop(step, None) is not None:
+        self._save()
+
+  def clear(self):
+    with self._lock:
+      self.steps = {}
+      self._save()
+
+class OutputManifest():
+  """Fingerprints of the files in an output directory, saved right next to them."""
+
+  # A record only holds while the file's size and mtime are unchanged, so outputs deleted or edited by hand get
+  # redone. Jobs can share an output directory, hence one thread safe instance per directory through of_dir().
+
+  FILE_NAME = '$outputs.json'
+  # Rewriting the whole manifest for every chunk would be quadratic on big directories
+  SAVE_INTERVAL = 1.0
+
+  _instances: dict[str, 'OutputManifest'] = {}
+  _instances_lock = threading.Lock()
+
+  @classmethod
+  def of_dir(cls, output_dir: str) -> 'OutputManifest':
+    output_dir = os.path.abspath(output_dir)
+    with cls._instances_lock:
+      if (manifest := cls._instances.get(output_dir)) is None:
+        manifest = cls._instances[output_dir] = cls(os.path.join(output_dir, cls.FILE_NAME))
+      return manifest
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._last_save = 0.0
+    try:
+      with open(path, 'r') as f:
+        self.files: dict[str, dict] = json.load(f)
+    except FileNotFoundError:
+      self.files = {}
+
+  @staticmethod
+  def _stat(filepath: str) -> Optional[list[int]]:
+    try:
+      st = os.stat(filepath)
+    except FileNotFoundError:
+      return None
+    return [st.st_size, st.st_mtime_ns]
+
+  def is_intact(self, filepath: str) -> bool:
+    """Whether filepath is exactly as this manifest last recorded it."""
+    with self._lock:
+      record = self.files.get(os.path.basename(filepath))
+    return record is not None and record['stat'] == self._stat(filepath)
+
+  def check(self, filepath: str, kind: str, fp: str) -> bool:
+    with self._lock:
+      record = self.files.get(os.path.basename(filepath))
+    return record is not None and record.get(kind) == fp and record['stat'] == self._stat(filepath)
+
+  def record(self, filepath: str, kind: str, fp: str, reset: bool = False):
+    """Record that filepath was just produced by a step of the given kind.
+
+    With reset, the fingerprints of other kinds are dropped, e.g. tags of a
+    freshly cut file.
+    """
+    name = os.path.basename(filepath)
+    with self._lock:
+      record = {} if reset else self.files.get(name, {})
+      record[kind] = fp
+      record['stat'] = self._stat(filepath)
+      self.files[name] = record
+      if time.monotonic() - self._last_save >= self.SAVE_INTERVAL:
+        self._save_locked()
+
+  def forget(self, filepath: str):
+    with self._lock:
+      self.files.pop(os.path.basename(filepath), None)
+
+  def save(self):
+    with self._lock:
+      self._save_locked()
+
+  def _save_locked(self):
+    MU.atomic_write_json(self.path, self.files)
+    self._last_save = time.monotonic()
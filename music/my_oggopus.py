@@ -0,0 +1,222 @@
+# Packet level reading and writing of Ogg Opus streams (RFC 7845), for cutting them at the exact sample without
+# decoding anything: the pre-skip and the final granule position trim the copied packets.
+#
+# Times are in samples at 48 kHz, the rate Opus always decodes at, counted from the first sample played back (i.e.
+# after the pre-skip).
+
+import struct
+import itertools
+from typing import BinaryIO, Iterator
+from dataclasses import dataclass
+
+SAMPLE_RATE = 48000
+# The pre-skip is a 16 bit field
+MAX_PRE_SKIP = 0xffff
+
+PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+CAPTURE_PATTERN = b'OggS'
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+# About a second of audio per page, like ffmpeg does
+PAGE_PACKETS = 50
+
+def _crc_table() -> list[int]:
+  table = []
+  for i in range(256):
+    crc = i << 24
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1) & 0xffffffff
+    table.append(crc)
+  return table
+
+CRC_TABLE = _crc_table()
+
+def ogg_crc(data: bytes) -> int:
+  crc = 0
+  for byte in data:
+    crc = ((crc << 8) & 0xffffffff) ^ CRC_TABLE[(crc >> 24) ^ byte]
+  return crc
+
+# Frame length in samples, by the config number in the TOC byte (RFC 6716, section 3.1)
+_FRAME_SAMPLES = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+def packet_samples(packet: bytes) -> int:
+  toc = packet[0]
+  code = toc & 0x3
+  frames = 1 if code == 0 else 2 if code in (1, 2) else packet[1] & 0x3f
+  return _FRAME_SAMPLES[toc >> 3] * frames
+
+@dataclass
+class OpusHeaders():
+  # The OpusHead and OpusTags packets
+  head: bytes
+  tags: bytes
+
+  @property
+  def pre_skip(self) -> int:
+    return struct.unpack_from('<H', self.head, 10)[0]
+
+  def with_pre_skip(self, pre_skip: int) -> 'OpusHeaders':
+    return OpusHeaders(head=self.head[:10] + struct.pack('<H', pre_skip) + self.head[12:], tags=self.tags)
+
+def _iter_pages(f: BinaryIO) -> Iterator[tuple[int, int, list[int], bytes]]:
+  """(granule position, serial number, lacing values, body) of each page."""
+  while header := f.read(PAGE_HEADER.size):
+    capture, _, _, granule, serial, _, _, num_segments = PAGE_HEADER.unpack(header)
+    if capture != CAPTURE_PATTERN:
+      raise ValueError(f"{f.name} isn't an Ogg file, or is corrupt")
+    lacing = list(f.read(num_segments))
+    yield (granule, serial, lacing, f.read(sum(lacing)))
+
+def _iter_page_packets(f: BinaryIO) -> Iterator[tuple[list[bytes], int]]:
+  """The packets completed on each page of the first logical stream, and the page's granule position."""
+  stream_serial = None
+  partial = b''
+  for granule, serial, lacing, body in _iter_pages(f):
+    if stream_serial is None:
+      stream_serial = serial
+    elif serial != stream_serial:
+      continue
+    packets = []
+    pos = 0
+    for value in lacing:
+      partial += body[pos:pos + value]
+      pos += value
+      if value < 255:
+        packets.append(partial)
+        partial = b''
+    yield (packets, granule)
+
+def _split_headers(path: str, pages: Iterator[tuple[list[bytes], int]]) -> tuple[OpusHeaders, list[bytes]]:
+  packets = []
+  for page_packets, _ in pages:
+    packets.extend(page_packets)
+    if len(packets) >= 2:
+      break
+  if len(packets) < 2 or not packets[0].startswith(b'OpusHead') or not packets[1].startswith(b'OpusTags'):
+    raise ValueError(f"{path} isn't an Ogg Opus file")
+  return (OpusHeaders(head=packets[0], tags=packets[1]), packets[2:])
+
+def read_headers(path: str) -> OpusHeaders:
+  with open(path, 'rb') as f:
+    headers, _ = _split_headers(path, _iter_page_packets(f))
+  return headers
+
+def iter_packets(path: str) -> Iterator[tuple[int, bytes]]:
+  """The audio packets of an Ogg Opus file, as (start time, packet).
+
+  Times are counted from the packets' own lengths, with the stream assumed to
+  start at 0: ffmpeg's remuxes of WebM files carry granule positions rounded
+  to the millisecond.
+  """
+  with open(path, 'rb') as f:
+    pages = _iter_page_packets(f)
+    headers, leftover = _split_headers(path, pages)
+    time = -headers.pre_skip
+    for packets in itertools.chain([leftover], (packets for packets, _ in pages)):
+      for packet in packets:
+        yield (time, packet)
+        time += packet_samples(packet)
+
+def read_boundaries(path: str) -> list[int]:
+  """The start time of every audio packet, and where the last one ends."""
+  boundaries = []
+  end = 0
+  for time, packet in iter_packets(path):
+    boundaries.append(time)
+    end = time + packet_samples(packet)
+  boundaries.append(end)
+  return boundaries
+
+class OpusWriter():
+  """Writes audio packets into a new Ogg Opus file, with the granule positions counted from the packets themselves.
+
+  The end of the last packet is trimmed, so that the stream plays back for
+  exactly length samples.
+  """
+
+  def __init__(self, path: str, headers: OpusHeaders, length: int, serial: int = 0x6d75736b):
+    self._file = open(path, 'wb')
+    self._serial = serial
+    self._sequence = 0
+    self._final_granule = headers.pre_skip + length
+    # Samples decoded from the pages written so far, including the pre-skip
+    self._granule = 0
+    self._page: list[bytes] = []
+    # Held back, since the last packet must go on a page of its own for the end to be trimmed
+    self._last = None
+    try:
+      self._write_page([headers.head], FLAG_BOS, 0)
+      self._write_page([headers.tags], 0, 0)
+    except BaseException:
+      self._file.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *exc):
+    if exc_type is None:
+      self.close()
+    else:
+      self._file.close()
+
+  def _write_page(self, packets: list[bytes], flags: int, granule: int):
+    lacing = bytearray()
+    for packet in packets:
+      lacing.extend([255] * (len(packet) // 255))
+      lacing.append(len(packet) % 255)
+    page = bytearray(PAGE_HEADER.pack(CAPTURE_PATTERN, 0, flags, granule, self._serial, self._sequence, 0, len(lacing)))
+    page += lacing
+    for packet in packets:
+      page += packet
+    struct.pack_into('<I', page, 22, ogg_crc(page))
+    self._file.write(page)
+    self._sequence += 1
+
+  def _flush_page(self):
+    if self._page:
+      self._write_page(self._page, 0, self._granule)
+      self._page = []
+
+  def write(self, packet: bytes):
+    if self._last is not None:
+      self._page.append(self._last)
+      self._granule += packet_samples(self._last)
+      if len(self._page) >= PAGE_PACKETS:
+        self._flush_page()
+    self._last = packet
+
+  def close(self):
+    with self._file:
+      self._flush_page()
+      if self._last is None:
+        raise ValueError(f"No audio packets written to {self._file.name}")
+      if not self._granule < self._final_granule <= self._granule + packet_samples(self._last):
+        raise ValueError(f"The packets written to {self._file.name} don't end within the last one")
+      self._write_page([self._last], FLAG_EOS, self._final_granule)
+
+def write_excerpt(path: str, dest: str, begin: int, end: int, pre_roll: int):
+  """Copy the packets of path that play from begin to end into dest, a stream that starts right at begin.
+
+  The packets start at least pre_roll samples early if they can, for the
+  decoder to settle, and whatever comes before begin is skipped through the
+  pre-skip.
+  """
+  headers = read_headers(path)
+  packets = []
+  start = None
+  for time, packet in iter_packets(path):
+    if time >= end:
+      break
+    if time + packet_samples(packet) <= begin - pre_roll:
+      continue
+    if start is None:
+      start = time
+    packets.append(packet)
+  start = -headers.pre_skip if start is None else start
+  if begin - start > MAX_PRE_SKIP:
+    raise ValueError(f"Can't skip {begin - start} samples at the start of {dest}")
+  with OpusWriter(dest, headers.with_pre_skip(begin - start), end - begin) as writer:
+    for packet in packets:
+      writer.write(packet)
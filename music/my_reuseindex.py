@@ -0,0 +1,103 @@
+# Persistent video ID -> file index of a --reuse directory.
+#
+# The index is only rescanned when the directory's mtime changes (i.e. a file was added, removed or renamed),
+# and even then only the new file names get parsed.
+
+import os
+import re
+import json
+import hashlib
+from typing import Optional
+
+import my_utils as MU
+
+# Video IDs are delimited by whatever yt-dlp's output templates tend to put around them, e.g. `Title [ID].ext`
+ID_DELIMITER = re.compile(r'[\s\[\]\(\)\{\}.,;]+')
+
+# IDs can also be glued to the title with these, e.g. `Title-ID.ext` or `ID_Title.ext`, but can contain them too
+ID_GLUE = re.compile(r'[-_]')
+# Longer runs of glued words are titles, not IDs
+MAX_ID_LEN = 64
+# Bumped whenever filename_video_ids() changes, so that old indexes get rescanned in full
+INDEX_VERSION = 2
+
+def filename_video_ids(filename: str) -> list[str]:
+  base, _ = os.path.splitext(filename)
+  ids = []
+  for token in ID_DELIMITER.split(base):
+    if not token:
+      continue
+    ids.append(token)
+    # Every run of consecutive glued words, so that looking up a glued ID stays a dict access
+    glues = [m.start() for m in ID_GLUE.finditer(token)]
+    starts = [0] + [pos + 1 for pos in glues]
+    ends = glues + [len(token)]
+    for i, start in enumerate(starts):
+      for end in ends[i:]:
+        if end - start > MAX_ID_LEN:
+          break
+        if start < end and (start, end) != (0, len(token)):
+          ids.append(token[start:end])
+  return list(dict.fromkeys(ids))
+
+class ReuseIndex():
+  def __init__(self, reuse_dir: str, index_dir: str, exts: list[str]):
+    self.reuse_dir = reuse_dir
+    self.exts = set(exts)
+    dir_hash = hashlib.md5(reuse_dir.encode('utf-8')).hexdigest()
+    self.index_path = os.path.join(index_dir, f"$reuse_index-{dir_hash}.json")
+    self.dir_mtime: Optional[int] = None
+    # filename -> video ID candidates
+    self.files: dict[str, list[str]] = {}
+    # video ID -> filenames
+    self.ids: dict[str, list[str]] = {}
+    self._load()
+
+  def _load(self):
+    try:
+      with open(self.index_path, 'r') as f:
+        data = json.load(f)
+    except FileNotFoundError:
+      return
+    if data.get('version') != INDEX_VERSION:
+      return
+    self.dir_mtime = data['dir_mtime']
+    self.files = data['files']
+    self._build_ids()
+
+  def _save(self):
+    MU.atomic_write_json(self.index_path, {'version': INDEX_VERSION, 'reuse_dir': self.reuse_dir, 'dir_mtime': self.dir_mtime, 'files': self.files})
+
+  def _build_ids(self):
+    self.ids = {}
+    for filename, video_ids in self.files.items():
+      for video_id in video_ids:
+        self.ids.setdefault(video_id, []).append(filename)
+
+  def rescan(self, full: bool = False) -> bool:
+    """Bring the index up to date, returns whether anything had to be scanned.
+
+    Unless full is set, this is a no-op if the directory's mtime hasn't changed,
+    and otherwise only the file names that weren't indexed yet are parsed.
+    """
+    dir_mtime = os.stat(self.reuse_dir).st_mtime_ns
+    if not full and dir_mtime == self.dir_mtime:
+      return False
+
+    old_files = {} if full else self.files
+    self.files = {}
+    for filename in os.listdir(self.reuse_dir):
+      _, ext = os.path.splitext(filename)
+      if ext not in self.exts:
+        continue
+      video_ids = old_files.get(filename)
+      if video_ids is None:
+        video_ids = filename_video_ids(filename)
+      self.files[filename] = video_ids
+    self.dir_mtime = dir_mtime
+    self._build_ids()
+    self._save()
+    return True
+
+  def lookup(self, video_id: str) -> list[str]:
+    return [os.path.join(self.reuse_dir, filename) for filename in self.ids.get(video_id, [])]
@@ -0,0 +1,36 @@
+# Shared plumbing of the SQLite backed stores (my_infocache, my_tagindex)
+
+import sqlite3
+import threading
+
+# SQLite's default limit on the number of host parameters is 999 on older versions
+MAX_QUERY_PARAMS = 500
+
+class SqliteStore():
+  """A single connection guarded by a lock, safe to share between threads.
+
+  Subclasses hold self._lock around every use of self._db.
+  """
+
+  def __init__(self, db_path: str, schema: str):
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(db_path, check_same_thread=False)
+    self._db.executescript(schema)
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def _query_in(self, sql: str, keys: list[str], *params) -> list[tuple]:
+    """Run sql with its `IN ({})` filled in for keys, in as many queries as it takes. The caller holds the lock."""
+    rows = []
+    for i in range(0, len(keys), MAX_QUERY_PARAMS):
+      batch = keys[i:i + MAX_QUERY_PARAMS]
+      rows.extend(self._db.execute(sql.format(','.join('?' * len(batch))), [*params, *batch]))
+    return rows
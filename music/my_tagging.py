@@ -0,0 +1,154 @@
+# Shared tag writing engine for the scripts in this directory.
+#
+# Every write is diffed against the file's current tags first: files that already have the desired tags are
+# never saved (saving rewrites the whole file), and the rest are loaded and saved in parallel.
+
+import concurrent.futures
+from typing import Any, Callable, Iterable, Iterator, Optional
+from dataclasses import dataclass, field
+
+import music_tag
+from mutagen.id3 import ID3, TXXX
+from mutagen.mp4 import MP4Tags, MP4FreeForm
+
+# Tags music_tag doesn't know about (e.g. REPLAYGAIN_TRACK_GAIN) are named with this prefix, and written straight
+# into the underlying mutagen file as each format's freeform tag
+RAW_TAG_PREFIX = 'raw:'
+
+@dataclass
+class TagWrite():
+  path: str
+  # Desired tag values, by music_tag tag name, or RAW_TAG_PREFIX + name for others
+  tags: dict[str, Any] = field(default_factory=dict)
+  # Computes more desired tags from the loaded file and the desired tags so far, for tags that depend on the current ones
+  derive: Optional[Callable[[Any, dict[str, Any]], dict[str, Any]]] = None
+  # The file's current tags as known from a tag index (see my_tagindex), if any. Files whose desired tags are all
+  # already there aren't even opened, and neither are any in a dry run.
+  current: Optional[dict[str, str]] = None
+
+@dataclass
+class TagWriteResult():
+  path: str
+  # Tags that differed, as name -> (old value, new value)
+  changed: dict[str, tuple[str, str]] = field(default_factory=dict)
+  error: Optional[Exception] = None
+
+@dataclass
+class TagReadResult():
+  path: str
+  # Tag name -> value, as strings
+  tags: Optional[dict[str, str]] = None
+  error: Optional[Exception] = None
+
+def tag_value_str(value) -> str:
+  # music_tag normalizes everything to strings (or ints, for e.g. tracknumber) on its side, compare on ours the same way
+  return '' if value is None else str(value)
+
+def get_raw_tag(mfile, key: str) -> Optional[str]:
+  tags = mfile.tags
+  if tags is None:
+    return None
+  if isinstance(tags, ID3):
+    frame = tags.get(f"TXXX:{key}")
+    return str(frame.text[0]) if frame is not None and frame.text else None
+  if isinstance(tags, MP4Tags):
+    values = tags.get(f"----:com.apple.iTunes:{key}")
+    return bytes(values[0]).decode('utf-8') if values else None
+  # Vorbis comments (ogg, opus, flac), keys are case insensitive
+  values = tags.get(key)
+  return values[0] if values else None
+
+def set_raw_tag(mfile, key: str, value: str):
+  if mfile.tags is None:
+    mfile.add_tags()
+  tags = mfile.tags
+  if isinstance(tags, ID3):
+    tags.add(TXXX(encoding=3, desc=key, text=[value]))
+  elif isinstance(tags, MP4Tags):
+    tags[f"----:com.apple.iTunes:{key}"] = [MP4FreeForm(value.encode('utf-8'))]
+  else:
+    tags[key] = [value]
+
+def get_tag(f, name: str):
+  if isinstance(f, dict):
+    # Indexed tags
+    return f.get(name)
+  if name.startswith(RAW_TAG_PREFIX):
+    return get_raw_tag(f.mfile, name[len(RAW_TAG_PREFIX):])
+  return f[name]
+
+def set_tag(f, name: str, value):
+  if name.startswith(RAW_TAG_PREFIX):
+    set_raw_tag(f.mfile, name[len(RAW_TAG_PREFIX):], tag_value_str(value))
+  else:
+    f[name] = value
+
+def diff_tags(f, tags: dict[str, Any]) -> dict[str, tuple[str, str]]:
+  changed = {}
+  for name, value in tags.items():
+    old = tag_value_str(get_tag(f, name))
+    new = tag_value_str(value)
+    if old != new:
+      changed[name] = (old, new)
+  return changed
+
+def read_tags(path: str, names: Iterable[str]) -> TagReadResult:
+  """Only the named tags of path, the loaded file (cover art and all) is dropped right away."""
+  result = TagReadResult(path=path)
+  try:
+    f = music_tag.load_file(path)
+    result.tags = {name: tag_value_str(get_tag(f, name)) for name in names}
+  except Exception as e:
+    result.error = e
+  return result
+
+def read_tags_batch(paths: Iterable[str], names: Iterable[str], jobs: int = 8) -> Iterator[TagReadResult]:
+  """read_tags() over a pool of jobs threads, yielding the results in the same order as the paths."""
+  names = list(names)
+  if jobs <= 1:
+    for path in paths:
+      yield read_tags(path, names)
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    yield from executor.map(lambda path: read_tags(path, names), paths)
+
+def desired_tags(write: TagWrite, f) -> dict[str, Any]:
+  tags = dict(write.tags)
+  if write.derive is not None:
+    tags.update(write.derive(f, tags))
+  return tags
+
+def write_tags(write: TagWrite, dry_run: bool = False) -> TagWriteResult:
+  """Bring a single file's tags to the desired values, saving it only if anything differs."""
+  result = TagWriteResult(path=write.path)
+  try:
+    if write.current is not None:
+      tags = desired_tags(write, write.current)
+      # Tags that aren't indexed can only be compared against the file itself
+      if all(name in write.current for name in tags):
+        result.changed = diff_tags(write.current, tags)
+        if not result.changed or dry_run:
+          return result
+    f = music_tag.load_file(write.path)
+    tags = desired_tags(write, f)
+    result.changed = diff_tags(f, tags)
+    if result.changed and not dry_run:
+      for name in result.changed:
+        set_tag(f, name, tags[name])
+      f.save()
+  except Exception as e:
+    result.error = e
+  return result
+
+def write_tags_batch(writes: Iterable[TagWrite], jobs: int = 8, dry_run: bool = False) -> Iterator[TagWriteResult]:
+  """Run writes over a pool of jobs threads, yielding the results in the same order as the writes.
+
+  Loading and saving is mostly file I/O, during which the GIL is released.
+  Errors don't stop the batch, they're reported in the results.
+  """
+  if jobs <= 1:
+    for write in writes:
+      yield write_tags(write, dry_run)
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    yield from executor.map(lambda write: write_tags(write, dry_run), writes)
@@ -0,0 +1,109 @@
+# Persistent index of the tags of the files in a music library, backed by a single SQLite database.
+#
+# Files are keyed by their absolute path, and their tags are only read again once their size or mtime changed
+# since they were indexed. Reading the current tags of a library, or finding the files that lack some tag, then
+# costs a stat per file instead of opening every one of them.
+
+import os
+import json
+from typing import Iterable
+
+import my_sqlite as MSQL
+import my_tagging as MT
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  -- JSON object of tag name -> value, as strings
+  tags TEXT NOT NULL
+);
+"""
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'music_tag_index.sqlite3')
+
+# The tags worth indexing, i.e. the ones the scripts read and edit
+INDEXED_TAGS = ['tracktitle', 'tracknumber', 'artist', 'albumartist', 'composer', 'album', 'comment']
+
+class TagIndex(MSQL.SqliteStore):
+  def __init__(self, db_path: str = DEFAULT_INDEX_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    super().__init__(db_path, SCHEMA)
+
+  def _store(self, entries: Iterable[tuple[str, os.stat_result, dict[str, str]]]):
+    with self._lock, self._db:
+      self._db.executemany(
+        'INSERT OR REPLACE INTO files (path, size, mtime_ns, tags) VALUES (?, ?, ?, ?)',
+        [(key, st.st_size, st.st_mtime_ns, json.dumps(tags)) for key, st, tags in entries])
+
+  def lookup(self, paths: Iterable[str]) -> tuple[dict[str, dict[str, str]], list[tuple[str, os.stat_result]]]:
+    """Tags of the paths unchanged since they were indexed, and the others along with their stat, to be read and store()'d.
+
+    Files that can't be stat'ed are reported and left out of both.
+    """
+    keys = {path: os.path.abspath(path) for path in paths}
+    with self._lock:
+      rows = self._query_in('SELECT path, size, mtime_ns, tags FROM files WHERE path IN ({})', list(set(keys.values())))
+    indexed = {key: (size, mtime_ns, tags) for key, size, mtime_ns, tags in rows}
+
+    fresh = {}
+    outdated = []
+    for path, key in keys.items():
+      try:
+        st = os.stat(path)
+      except OSError as e:
+        print(f"{path}: Error: {e!r}")
+        continue
+      row = indexed.get(key)
+      if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+        fresh[path] = json.loads(row[2])
+      else:
+        # Stat before reading, a file modified in between just gets read again next time
+        outdated.append((path, st))
+    return fresh, outdated
+
+  def store(self, entries: Iterable[tuple[str, os.stat_result, dict[str, str]]]):
+    """Record the INDEXED_TAGS read from each path, as (path, stat before reading, tags), in one transaction."""
+    self._store([(os.path.abspath(path), st, tags) for path, st, tags in entries])
+
+  def refresh(self, paths: Iterable[str], jobs: int = 8) -> dict[str, dict[str, str]]:
+    """Current tags of each path, reading only the files that changed since they were last indexed.
+
+    Files that can't be read are reported and left out of the result.
+    """
+    result, outdated = self.lookup(paths)
+    read_entries = []
+    for (path, st), read in zip(outdated, MT.read_tags_batch([path for path, _ in outdated], INDEXED_TAGS, jobs)):
+      if read.error is not None:
+        print(f"{path}: Error: {read.error!r}")
+        continue
+      result[path] = read.tags
+      read_entries.append((os.path.abspath(path), st, read.tags))
+    self._store(read_entries)
+    return result
+
+  def update(self, writes: Iterable[tuple[str, dict[str, str]]]):
+    """Record tags just written to each path, as (path, tags), merged into what was indexed before."""
+    writes = [(os.path.abspath(path), path, tags) for path, tags in writes]
+    with self._lock:
+      rows = self._query_in('SELECT path, tags FROM files WHERE path IN ({})', [key for key, _, _ in writes])
+    indexed = {key: json.loads(tags) for key, tags in rows}
+    entries = []
+    for key, path, tags in writes:
+      written = {name: MT.tag_value_str(value) for name, value in tags.items() if name in INDEXED_TAGS}
+      entries.append((key, os.stat(path), {**indexed.get(key, {}), **written}))
+    self._store(entries)
+
+  def missing(self, tag: str, paths: Iterable[str]) -> list[str]:
+    """Those of paths (which should have just been refreshed) whose tag is empty."""
+    if tag not in INDEXED_TAGS:
+      # Every file would look like it lacks it
+      raise ValueError(f"{tag} isn't one of the indexed tags: {', '.join(INDEXED_TAGS)}")
+    keys = {os.path.abspath(path): path for path in paths}
+    # music_tag reads a missing number as 0
+    with self._lock:
+      rows = self._query_in(
+        "SELECT path FROM files WHERE COALESCE(json_extract(tags, ?), '') IN ('', '0') AND path IN ({})",
+        list(keys), f'$."{tag}"')
+    return sorted(keys[key] for key, in rows)
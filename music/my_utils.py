@@ -1,9 +1,10 @@
 import sys
 import os
+import json
 import string
 import requests
 import shutil
-from typing import Final, List, Set
+from typing import Final, Iterator, List, Optional, Set
 
 # https://stackoverflow.com/a/3041990
 def query_yes_no(question, default="yes"):
@@ -103,6 +104,13 @@ def int_to_roman_unicode(number: int) -> str:
     return "<UNKNOWN>"
   return ROMAN_UNICODE_UPPER[number - 1]
 
+def atomic_write_json(path: str, data):
+  # Write then rename, a run cancelled mid-write must not leave a truncated file behind
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(data, f)
+  os.replace(tmp_path, path)
+
 def file_ext_stripper(exts: Set[str]):
   def stripper(s: str) -> str:
     dot_idx = s.rfind('.')
@@ -114,3 +122,33 @@ def file_ext_stripper(exts: Set[str]):
     else:
       return s
   return stripper
+
+def iter_files_with_ext(root: str, exts: Set[str], recursive: bool = False, min_mtime: Optional[float] = None) -> Iterator[str]:
+  """Paths of the files under root whose extension (without the dot) is in exts, found in a single walk.
+
+  Like glob, hidden files and directories are skipped and the paths are
+  relative to root. Each directory is sorted on its own, so the files stream
+  out in a stable order without the whole tree being listed first. With
+  min_mtime, older files are skipped.
+  """
+  def walk(dirpath: str, prefix: str) -> Iterator[str]:
+    with os.scandir(dirpath) as it:
+      entries = sorted(it, key=lambda entry: entry.name)
+    subdirs = []
+    for entry in entries:
+      if entry.name.startswith('.'):
+        continue
+      # Symlinked directories are left alone, they might loop
+      if entry.is_dir(follow_symlinks=False):
+        subdirs.append(entry)
+        continue
+      _, ext = os.path.splitext(entry.name)
+      if ext[1:] not in exts:
+        continue
+      if min_mtime is not None and entry.stat().st_mtime < min_mtime:
+        continue
+      yield prefix + entry.name
+    if recursive:
+      for entry in subdirs:
+        yield from walk(entry.path, prefix + entry.name + os.sep)
+  yield from walk(root, '')
@@ -68,7 +68,8 @@ def format_table_data(headers: list[str], dat: list[Union[str, list[str]]], tab_
 
   return '\n'.join(out)
 
-def parse_table_data(content: str, advanced=False) -> list[list[str]]:
+def parse_table_data(content: str, advanced=False, merge_tabs=True) -> list[list[str]]:
+  # merge_tabs lets the user line up columns with extra tabs, at the cost of empty cells merging into the delimiter
   lines = content.splitlines()
 
   if advanced:
@@ -77,7 +78,7 @@ def parse_table_data(content: str, advanced=False) -> list[list[str]]:
       if line.startswith('#$'):
         directives.append(line.removeprefix('#$'))
 
-  TAB_DELIMIT = re.compile(r'\t+')
+  TAB_DELIMIT = re.compile(r'\t+' if merge_tabs else r'\t')
   rows = [TAB_DELIMIT.split(line)
           for line in lines
           if not line.startswith('#') and line != '']
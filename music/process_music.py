@@ -7,23 +7,46 @@ import shutil
 import itertools
 import hashlib
 import argparse
+import io
 import json
-from typing import Optional
-from dataclasses import dataclass, field
+import time
+import threading
+import queue
+import contextlib
+import bisect
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+from dataclasses import dataclass, field, asdict
 
 import ffmpeg
-import music_tag
 from yt_dlp import YoutubeDL
 
 # Local script files
 import my_utils as MU
-
-@dataclass
+import my_infocache as MIC
+import my_blobstore as MBS
+import my_reuseindex as MRI
+import my_journal as MJ
+import my_tagging as MT
+import my_oggopus as MOO
+
+# Immutable so that a single instance can be shared by every chunk (and job) it applies to, see intern_tag_op()
+@dataclass(frozen=True, slots=True)
 class TagOp():
   name: str = ''
   value: str = ''
 
-@dataclass
+_TAG_OP_POOL: dict[tuple[str, str], TagOp] = {}
+
+def intern_tag_op(name: str, value: str) -> TagOp:
+  # Playlist-scale command files repeat the same few tags (album, artist...) over thousands of chunks
+  key = (name, value)
+  if (op := _TAG_OP_POOL.get(key)) is None:
+    op = _TAG_OP_POOL.setdefault(key, TagOp(name=name, value=value))
+  return op
+
+@dataclass(slots=True)
 class Chunk():
   begin_time: float = 0.0
   end_time: float | str = ''
@@ -31,220 +54,794 @@ class Chunk():
   tag_ops: list[TagOp] = field(default_factory=list)
   out_basename: Optional[str] = None
   out_filepath: Optional[str] = None
+  split_fingerprint: Optional[str] = None
+  # ReplayGain tags, see loudness_job(). None without --replaygain, saves an empty dict per chunk
+  gain_tags: Optional[dict[str, str]] = None
 
-@dataclass
+@dataclass(slots=True)
 class Job():
   url: str = ''
   mainfile: str = ''
   mainfile_ext: str = ''
+  # Extension of the chunks cut out of mainfile, see output_ext()
+  out_ext: str = ''
+  # Identifies the content of mainfile, see obtain_video()
+  mainfile_source: str = ''
   chunk_by_chapter: bool = False
   prefix: Optional[str] = None
   suffix: Optional[str] = None
   wksp_id: str = ''
+  # Absolute path of the workspace, so that nothing depends on the cwd and jobs can run concurrently
+  wksp_dir: str = ''
   video_info: dict = field(default_factory=dict)
   tag_ops: list[TagOp] = field(default_factory=list)
   chunks: list[Chunk] = field(default_factory=list)
+  # 0-based position inside the playlist this job was expanded from, see expand_playlist_job()
+  playlist_index: Optional[int] = None
+  journal: Optional[MJ.Journal] = field(default=None, repr=False)
 
-@dataclass
+@dataclass(slots=True)
 class InputStruct():
   job_list: list[Job] = field(default_factory=list)
 
-def use_pattern(pattern, txt, idx):
-  return pattern.format(
-    index = idx + 1,
-    index_roman = MU.int_to_roman_unicode(idx + 1))
+def use_pattern(pattern, txt, idx, playlist_idx=None):
+  macros = {
+    'index': idx + 1,
+    'index_roman': MU.int_to_roman_unicode(idx + 1),
+  }
+  # Only playlist entries have these, a pattern using them on anything else fails like any unknown macro
+  if playlist_idx is not None:
+    macros['playlist_index'] = playlist_idx + 1
+    macros['playlist_index_roman'] = MU.int_to_roman_unicode(playlist_idx + 1)
+  return pattern.format(**macros)
 
 def calc_workspace_id(url: str) -> str:
   return hashlib.md5(url.encode('utf-8')).hexdigest()
 
-# Pass 1
-def pass_postprocess_info(input_struct: InputStruct):
-  print(input_struct)
-  for job in input_struct.job_list:
-    chunks = job.chunks
-    for i in range(len(chunks)):
-      curr_chunk = chunks[i]
-      next_chunk = chunks[i + 1] if i + 1 < len(chunks) else None
-
-      if curr_chunk.end_time == 'NEXTCHUNK':
-        if next_chunk is not None:
-          curr_chunk.end_time = next_chunk.begin_time
-        else:
-          curr_chunk.end_time = 'VIDEOLENGTH'
+# Serializes interactive prompts coming from concurrently running jobs
+PROMPT_LOCK = threading.Lock()
 
-# Pass 2
-def pass_prepare_yt_dlp(input_struct: InputStruct):
-  # TODO maybe add a cache timeout for video info?
-  for job in input_struct.job_list:
-    wksp_id = calc_workspace_id(job.url)
-    os.makedirs(wksp_id, exist_ok=True)
+@dataclass
+class Workspace():
+  # Held while downloading, jobs of the same URL share a workspace and would otherwise download into it at once
+  lock: threading.Lock = field(default_factory=threading.Lock)
+  journal: Optional[MJ.Journal] = None
+
+_workspaces: dict[str, Workspace] = {}
+_workspaces_lock = threading.Lock()
+
+def get_workspace(wksp_dir: str) -> Workspace:
+  with _workspaces_lock:
+    return _workspaces.setdefault(wksp_dir, Workspace())
+
+def run_ffmpeg(stream):
+  # Capture the output, otherwise concurrently running ffmpeg instances trample over each other's progress lines
+  try:
+    ffmpeg.run(stream, capture_stdout=True, capture_stderr=True)
+  except ffmpeg.Error as e:
+    print(e.stderr.decode('utf-8', errors='replace'))
+    raise
+
+# Pass 1, run on each job as soon as it's parsed
+def postprocess_job(job: Job):
+  chunks = job.chunks
+  for i in range(len(chunks)):
+    curr_chunk = chunks[i]
+    next_chunk = chunks[i + 1] if i + 1 < len(chunks) else None
+
+    if curr_chunk.end_time == 'NEXTCHUNK':
+      if next_chunk is not None:
+        curr_chunk.end_time = next_chunk.begin_time
+      else:
+        curr_chunk.end_time = 'VIDEOLENGTH'
 
-    info_file_path = os.path.join(wksp_id, '$info.json')
-    try:
-      with open(info_file_path, 'r') as info_file:
-        print('-- $info.json found, loading video info')
-        info = json.load(info_file)
-    except:
-      print('-- $info.json not found, downloading')
-      info = ydl.extract_info(job.url, download=False)
-      with open(info_file_path, 'w') as info_file:
-        print('-- Saving $info.json')
-        info_file.write(json.dumps(info))
-
-    # Add an empty file for easy identification inside a file browser
-    marker_file_path = os.path.join(wksp_id, '$$ ' + MU.format_filename(info['title']))
+class YdlPool():
+  """Bounded pool of worker threads for extracting video info.
+
+  YoutubeDL instances aren't meant to be shared between threads, so each
+  worker lazily creates its own, and they're all closed together with the pool.
+  """
+
+  def __init__(self, ydl_opts: dict, max_workers: int, name: str):
+    self.ydl_opts = ydl_opts
+    self.executor = ThreadPoolExecutor(max_workers=max(max_workers, 1), thread_name_prefix=name)
+    self._local = threading.local()
+    self._instances = contextlib.ExitStack()
+    self._instances_lock = threading.Lock()
+
+  def _thread_ydl(self) -> YoutubeDL:
+    if (own_ydl := getattr(self._local, 'ydl', None)) is None:
+      with self._instances_lock:
+        own_ydl = self._instances.enter_context(YoutubeDL(self.ydl_opts))
+      self._local.ydl = own_ydl
+    return own_ydl
+
+  def extract_info(self, url: str) -> dict:
+    """Extract on the calling thread, with that thread's own YoutubeDL instance."""
+    own_ydl = self._thread_ydl()
+    return own_ydl.sanitize_info(own_ydl.extract_info(url, download=False))
+
+  def close(self):
+    self.executor.shutdown(wait=True)
+    self._instances.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class InfoRevalidator():
+  """Refreshes stale video infos in the background, while the caller goes on with the stale ones."""
+
+  def __init__(self, info_cache: MIC.VideoInfoCache, ydl_opts: dict):
+    self.info_cache = info_cache
+    self.pool = YdlPool({**ydl_opts, 'quiet': True}, max_workers=2, name='revalidate')
+
+  def submit(self, url: str):
+    self.pool.executor.submit(self._refresh, url)
+
+  def _refresh(self, url: str):
     try:
-      open(marker_file_path, 'x').close()
-    except:
-      pass
+      self.info_cache.put(url, self.pool.extract_info(url))
+    except Exception as e:
+      print(f"-- [WARN] Failed to refresh video info of {url}: {e!r}")
+
+  def wait(self):
+    self.pool.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.wait()
+
+def entry_url(entry: dict) -> str:
+  return entry.get('webpage_url') or entry['url']
+
+def resolve_info(url: str, cached: Optional[MIC.CachedInfo], info_cache: MIC.VideoInfoCache, extractor: YdlPool, revalidator: InfoRevalidator) -> dict:
+  if cached is not None:
+    print(f"-- Video info of {url} found in cache")
+    if cached.stale:
+      print(f"-- Cached video info of {url} is stale, refreshing it in the background")
+      revalidator.submit(url)
+    return cached.info
+  print(f"-- Video info of {url} not cached, downloading")
+  info = extractor.extract_info(url)
+  info_cache.put(url, info)
+  return info
+
+def expand_playlist_job(job: Job) -> list[Job]:
+  """One job per entry of the playlist job, each inheriting the playlist's settings and tags.
+
+  The entries only come with a flat info (ID, URL, title), their full info is
+  resolved just like any other job's.
+  """
+  entries = [entry for entry in job.video_info.get('entries') or [] if entry]
+  print(f"-- {job.url} is a playlist of {len(entries)} videos, expanding it")
+  if job.chunks:
+    print(f"-- [WARN] Ignoring the chunks of playlist {job.url}, they can't be told apart between its entries")
+  entry_jobs = []
+  for idx, entry in enumerate(entries):
+    entry_job = Job(
+      url=entry_url(entry),
+      chunk_by_chapter=job.chunk_by_chapter,
+      prefix=job.prefix,
+      suffix=job.suffix,
+      playlist_index=idx,
+      tag_ops=list(job.tag_ops))
+    if not job.chunk_by_chapter:
+      # Each entry as a whole
+      entry_job.chunks.append(Chunk(begin_time=0.0, end_time='VIDEOLENGTH', chunk_name=entry.get('title') or entry['id']))
+    entry_jobs.append(entry_job)
+  return entry_jobs
+
+def resolve_job(job: Job, cached: Optional[MIC.CachedInfo], info_cache: MIC.VideoInfoCache, extractor: YdlPool, revalidator: InfoRevalidator) -> Optional[list[Job]]:
+  """Resolve the job's video info, returns the jobs replacing it if it turned out to be a playlist."""
+  job.video_info = resolve_info(job.url, cached, info_cache, extractor, revalidator)
+  if not MIC.is_playlist(job.video_info):
+    return None
+  if job.playlist_index is not None:
+    raise RuntimeError(f"{job.url} is a playlist inside a playlist, which isn't supported")
+  return expand_playlist_job(job)
+
+def prepare_job(job: Job, work_dir: str):
+  wksp_id = calc_workspace_id(job.url)
+  wksp_dir = os.path.join(work_dir, wksp_id)
+  os.makedirs(wksp_dir, exist_ok=True)
+
+  # yt-dlp downloads from an info file, this is the only reason it's still saved to the workspace
+  info_file_path = os.path.join(wksp_dir, '$info.json')
+  with open(info_file_path, 'w') as info_file:
+    info_file.write(json.dumps(job.video_info))
+
+  # Add an empty file for easy identification inside a file browser
+  marker_file_path = os.path.join(wksp_dir, '$$ ' + MU.format_filename(job.video_info['title']))
+  try:
+    open(marker_file_path, 'x').close()
+  except FileExistsError:
+    pass
+
+  job.wksp_id = wksp_id
+  job.wksp_dir = wksp_dir
+
+def resolve_jobs(jobs: list[Job], info_cache: MIC.VideoInfoCache, extractor: YdlPool, revalidator: InfoRevalidator) -> list[Job]:
+  """Resolve the video info of all jobs, returns them with the playlists replaced by their entries."""
+  cached_infos = info_cache.get_many(job.url for job in jobs)
+  # Cache hits are cheap, but misses each cost a round trip or a few, hence fanning out over the extractor's pool
+  futures = [
+    extractor.executor.submit(resolve_job, job, cached_infos.get(job.url), info_cache, extractor, revalidator)
+    for job in jobs]
+  resolved = []
+  for job, future in zip(jobs, futures):
+    entry_jobs = future.result()
+    resolved.extend([job] if entry_jobs is None else entry_jobs)
+  return resolved
 
-    job.wksp_id = wksp_id
-    job.video_info = info
+# Pass 2
+def pass_prepare_yt_dlp(input_struct: InputStruct, work_dir: str, info_cache: MIC.VideoInfoCache, extractor: YdlPool, revalidator: InfoRevalidator):
+  job_list = resolve_jobs(input_struct.job_list, info_cache, extractor, revalidator)
+  # Playlist entries come out unresolved, with them it takes a second round
+  entry_jobs = [job for job in job_list if not job.video_info]
+  if entry_jobs:
+    resolve_jobs(entry_jobs, info_cache, extractor, revalidator)
+  for job in job_list:
+    prepare_job(job, work_dir)
+  input_struct.job_list = job_list
 
 # Pass 3
+def expand_job(job: Job):
+  chunks = job.chunks
+
+  # Section: generating new chunks
+  # (there should be no such thing happening later as we'll proceed to post process chunk info)
+  video_chapters = job.video_info.get('chapters')
+  if job.chunk_by_chapter and video_chapters:
+    for chap in video_chapters:
+      chunks.append(Chunk(
+        begin_time=chap['start_time'],
+        end_time=chap['end_time'],
+        chunk_name=chap['title'],
+        out_basename=MU.format_filename(chap['title'])))
+
+  name_chunks(job)
+
+def name_chunks(job: Job):
+  for i, chunk in enumerate(job.chunks):
+    # NOTE: we leave 'end_time' special value VIDEOLENGTH as is because it's easy to compute, and knowing it is required in split_job()
+    # output FileName
+    fn = ""
+    if job.prefix:
+      fn = use_pattern(job.prefix, fn, i, job.playlist_index)
+    fn += chunk.chunk_name
+    if job.suffix:
+      fn += use_pattern(job.suffix, fn, i, job.playlist_index)
+    chunk.out_basename = fn
+
 def pass_video_dependent_info(input_struct: InputStruct):
   for job in input_struct.job_list:
-    chunks = job.chunks
+    expand_job(job)
 
-    # Section: generating new chunks
-    # (there should be no such thing happening later as we'll proceed to post process chunk info)
-    video_chapters = job.video_info.get('chapters')
-    if job.chunk_by_chapter and video_chapters:
-      for chap in video_chapters:
-        chunks.append(Chunk(
-          begin_time=chap['start_time'],
-          end_time=chap['end_time'],
-          chunk_name=chap['title'],
-          out_basename=MU.format_filename(chap['title'])))
-
-    for i, chunk in enumerate(chunks):
-      # NOTE: we leave 'end_time' special value VIDEOLENGTH as is because it's easy to compute, and knowing it is required in pass_split_chunks()
-      # output FileName
-      fn = ""
-      if job.prefix:
-        fn = use_pattern(job.prefix, fn, i)
-      fn += chunk.chunk_name
-      if job.suffix:
-        fn += use_pattern(job.suffix, fn, i)
-      chunk.out_basename = fn
-
-def obtain_video_with_yt_dlp(video_url: str) -> tuple[str, str]:
-  existing_files = set(os.listdir())
-  ydl.download_with_info_file('$info.json')
-  for file in os.listdir():
-    if file not in existing_files:
-      _, ext = os.path.splitext(file)
-      # This is our downloaded video file
-      # We don't try to get the filename from yt-dlp because AFIAK that's unstable across versions
-      # and trying to duplicate their title legalize logic is a pain in he ass
-      mainfile = f"$mainfile{ext}"
-      os.rename(file, mainfile)
-      return (mainfile, ext)
+# Containers that the chunks get cut into another container from, by audio codec, as part of the cut itself.
+# Youtube serves Opus in .webm, which foobar2000 doesn't like.
+REMUX_EXTS = {
+  '.webm': {'opus': '.ogg', 'vorbis': '.ogg'},
+}
+
+def probe_audio_codec(mainfile: str) -> Optional[str]:
+  for stream in ffmpeg.probe(mainfile)['streams']:
+    if stream['codec_type'] == 'audio':
+      return stream['codec_name']
+  return None
+
+def output_ext(job: Job) -> str:
+  remux_exts = REMUX_EXTS.get(job.mainfile_ext)
+  if remux_exts is None:
+    return job.mainfile_ext
+  # Probing costs an ffprobe run, remember the codec for as long as the file stays the same
+  probe_fp = MJ.fingerprint(job.mainfile_source)
+  if (record := job.journal.get('probe', probe_fp)) is None:
+    record = {'codec': probe_audio_codec(job.mainfile)}
+    job.journal.mark_done('probe', probe_fp, record)
+  return remux_exts.get(record['codec'], job.mainfile_ext)
+
+def journaled_file(job: Job, step: str, fp: str) -> Optional[str]:
+  if (record := job.journal.get(step, fp)) is None:
+    return None
+  path = os.path.join(job.wksp_dir, record['file'])
+  return path if os.path.isfile(path) else None
+
+# The obtain_video*() functions return (mainfile path, extension, source), where source identifies the content of
+# the audio file: the name of its blob in the store
+
+def obtain_video_with_yt_dlp(job: Job, ydl_opts: dict, store: MBS.BlobStore, download_fp: str) -> tuple[str, str, str]:
+  if (downloaded := journaled_file(job, 'fetch', download_fp)) is None:
+    downloaded = fetch_video_with_yt_dlp(job, ydl_opts)
+    job.journal.mark_done('fetch', download_fp, {'file': os.path.basename(downloaded)})
+
+  _, ext = os.path.splitext(downloaded)
+  blob = store.put(downloaded, job.video_info['id'], move=True)
+  mainfile = os.path.join(job.wksp_dir, f"$mainfile{ext}")
+  store.link(blob, mainfile)
+  return (mainfile, ext, os.path.basename(blob))
+
+class DownloadCapture():
+  """Collects the file paths yt-dlp reports through its hooks, for a single download."""
+
+  def __init__(self):
+    self.downloaded: list[str] = []
+    self.final: list[str] = []
+
+  def progress_hook(self, d: dict):
+    # Also reported for files that were already downloaded
+    if d['status'] == 'finished':
+      self.downloaded.append(d['filename'])
+
+  def post_hook(self, filepath: str):
+    # Called once every postprocessor (merging formats, mostly) is done with the file
+    self.final.append(filepath)
+
+  def result(self) -> Optional[str]:
+    paths = self.final or self.downloaded
+    return os.path.abspath(paths[-1]) if paths else None
+
+def fetch_video_with_yt_dlp(job: Job, ydl_opts: dict) -> str:
+  capture = DownloadCapture()
+  # A YoutubeDL instance per download, so that each job writes into its own workspace without touching the cwd
+  job_ydl_opts = {
+    **ydl_opts,
+    'paths': {'home': job.wksp_dir},
+    # $-prefixed like the rest of the workspace files, so that -c leaves it alone
+    'outtmpl': {'default': '$download.%(ext)s'},
+    'progress_hooks': [capture.progress_hook],
+    'post_hooks': [capture.post_hook],
+  }
+  with YoutubeDL(job_ydl_opts) as job_ydl:
+    job_ydl.download_with_info_file(os.path.join(job.wksp_dir, '$info.json'))
+  if (downloaded := capture.result()) is None or not os.path.isfile(downloaded):
+    raise RuntimeError(f"yt-dlp didn't produce any file for {job.url}")
+  return downloaded
 
 MUSIC_EXTS = ['.mp3', '.m4a', '.flac', '.alac', '.wav', '.opus']
 
-def obtain_video_reuse(video_id: str, reuse_dir: os.path) -> Optional[tuple[str, str]]:
+def obtain_video_reuse(job: Job, reuse_index: MRI.ReuseIndex, store: MBS.BlobStore) -> Optional[tuple[str, str, str]]:
+  video_id = job.video_info['id']
   # Try to find a existing file
-  for filepath in os.listdir(reuse_dir):
-    filename = os.path.basename(filepath)
-    base, ext = os.path.splitext(filename)
-    if (ext in MUSIC_EXTS
-      and base.find(video_id) != -1
-      and MU.query_yes_no(f"-- Reuse '{filepath}' for the video {video_id}?")
-    ):
-      mainfile = f"./$mainfile{ext}"
-      shutil.copyfile(filepath, mainfile)
-      return (mainfile, ext)
+  for filepath in reuse_index.lookup(video_id):
+    _, ext = os.path.splitext(filepath)
+    with PROMPT_LOCK:
+      if not MU.query_yes_no(f"-- Reuse '{filepath}' for the video {video_id}?"):
+        continue
+    blob = store.put(filepath, video_id)
+    mainfile = os.path.join(job.wksp_dir, f"$mainfile{ext}")
+    store.link(blob, mainfile)
+    return (mainfile, ext, os.path.basename(blob))
   return None
 
-def obtain_video(video_id: str, video_url: str, reuse_dir: Optional[os.path]) -> tuple[str, str]:
+def obtain_video(job: Job, reuse_index: Optional[MRI.ReuseIndex], ydl_opts: dict, store: MBS.BlobStore, download_fp: str) -> tuple[str, str, str]:
   # Use iglob to avoid overhead of collecting into a list, we just want the first item
   # TODO maybe print a warning if there is more than one $mainfile.*
-  for mainfile in glob.iglob('$mainfile.*'):
+  for mainfile in glob.iglob(os.path.join(glob.escape(job.wksp_dir), '$mainfile.*')):
     print(f"-- {mainfile} already exists, skipping dowload")
     _, ext = os.path.splitext(mainfile)
-    return (mainfile, ext)
-
-  if reuse_dir is not None:
-    result = obtain_video_reuse(video_id, reuse_dir)
+    # Left over by a version of this script without journals, hash it once so that it gets recorded
+    return (mainfile, ext, MBS.hash_file(mainfile)[:16])
+
+  # Same video, but reached through another URL (and thus another workspace)
+  if blob := store.find(job.video_info['id']):
+    print(f"-- {blob} already stored, skipping download")
+    _, ext = os.path.splitext(blob)
+    mainfile = os.path.join(job.wksp_dir, f"$mainfile{ext}")
+    store.link(blob, mainfile)
+    return (mainfile, ext, os.path.basename(blob))
+
+  if reuse_index is not None:
+    result = obtain_video_reuse(job, reuse_index, store)
     if result is not None:
       print('-- Reused existing file.')
       return result
 
-  return obtain_video_with_yt_dlp(video_url)
+  return obtain_video_with_yt_dlp(job, ydl_opts, store, download_fp)
 
 # Pass 4
-def pass_download_yt_dlp(input_struct: InputStruct, reuse_dir: Optional[os.path]):
-  for job in input_struct.job_list:
-    os.chdir(job.wksp_id)
-    mainfile, ext = obtain_video(job.video_info['id'], job.url, reuse_dir)
-    job.mainfile = mainfile
-    job.mainfile_ext = ext
-    if ext == '.webm':
-      # TODO actually make sure it's an opus/vorbis stream...
-      basename, _ = os.path.splitext(mainfile)
-      new_name = f"{basename}.ogg"
-      stream = ffmpeg.input(mainfile)
-      stream = ffmpeg.output(stream, new_name, acodec="copy")
-      stream = ffmpeg.overwrite_output(stream)
-      ffmpeg.run(stream)
-      job.mainfile = new_name
-      job.mainfile_ext = '.ogg'
-      os.remove(mainfile)
-    os.chdir('..')
+def download_job(job: Job, reuse_index: Optional[MRI.ReuseIndex], ydl_opts: dict, store: MBS.BlobStore, force: bool = False):
+  wksp = get_workspace(job.wksp_dir)
+  with wksp.lock:
+    # One journal per workspace, so that --force clears it only once, and a later job sees the downloads of the earlier
+    if wksp.journal is None:
+      wksp.journal = MJ.Journal(os.path.join(job.wksp_dir, '$journal.json'))
+      if force:
+        wksp.journal.clear()
+    job.journal = wksp.journal
+
+    download_fp = MJ.fingerprint(job.video_info['id'], ydl_opts['format'])
+    if (mainfile := journaled_file(job, 'download', download_fp)) is not None:
+      print(f"-- {mainfile} already downloaded, skipping")
+      _, ext = os.path.splitext(mainfile)
+      source = job.journal.get('download', download_fp)['source']
+    else:
+      mainfile, ext, source = obtain_video(job, reuse_index, ydl_opts, store, download_fp)
+      job.journal.mark_done('download', download_fp, {'file': os.path.basename(mainfile), 'source': source})
+  job.mainfile = mainfile
+  job.mainfile_ext = ext
+  job.mainfile_source = source
+  job.out_ext = output_ext(job)
+
+# Pass 5, optional
+def analyze_job(job: Job, snap_seconds: Optional[float], auto_chunks: bool, gap_db: float):
+  # numpy is only needed for this pass
+  import my_analysis as MA
+
+  analysis_fp = MJ.fingerprint(job.mainfile_source, gap_db, MA.ANALYSIS_VERSION)
+  if (record := job.journal.get('analyze', analysis_fp)) is None:
+    print(f"-- Analyzing {job.url} for gaps between pieces")
+    envelope = MA.compute_envelope(job.mainfile)
+    record = {'gaps': MA.find_gaps(envelope, gap_db)}
+    job.journal.mark_done('analyze', analysis_fp, record)
+  gaps = record['gaps']
+
+  if auto_chunks and not job.chunks:
+    for begin_time, end_time in MA.propose_chunks(gaps, job.video_info['duration']):
+      job.chunks.append(Chunk(begin_time=begin_time, end_time=end_time, chunk_name=f"Part {len(job.chunks) + 1}"))
+    name_chunks(job)
+    print(f"-- Proposed {len(job.chunks)} chunks for {job.url}:")
+    for chunk in job.chunks:
+      print(f"   {MU.strformat_seconds(chunk.begin_time)} {MU.strformat_seconds(chunk.end_time)} {chunk.chunk_name}")
+    return
 
-# Pass 6
-def pass_split_chunks(input_struct: InputStruct, output_dir: Optional[os.path]):
-  for job in input_struct.job_list:
-    # Assume cwd is already in work_dir, so just wksp_id is enough
-    output_prefix = output_dir if output_dir is not None else job.wksp_id
-    audio_filepath = os.path.join(job.wksp_id, job.mainfile)
+  if snap_seconds is None:
+    return
+  for chunk in job.chunks:
+    # Leave the edges of the video alone, there's nothing to snap to beyond them
+    if chunk.begin_time > 0:
+      snapped = MA.snap_time(chunk.begin_time, gaps, snap_seconds, is_begin=True)
+      if snapped != chunk.begin_time:
+        print(f"-- Snapped beginning of '{chunk.chunk_name}' from {MU.strformat_seconds(chunk.begin_time)} to {MU.strformat_seconds(snapped)}")
+        chunk.begin_time = snapped
+    if chunk.end_time != 'VIDEOLENGTH':
+      snapped = MA.snap_time(chunk.end_time, gaps, snap_seconds, is_begin=False)
+      if snapped != chunk.end_time:
+        print(f"-- Snapped end of '{chunk.chunk_name}' from {MU.strformat_seconds(chunk.end_time)} to {MU.strformat_seconds(snapped)}")
+        chunk.end_time = snapped
+
+# Pass 5.5, optional
+def loudness_job(job: Job):
+  # numpy is only needed for this pass
+  import my_analysis as MA
+
+  ranges = [(chunk.begin_time, None if chunk.end_time == 'VIDEOLENGTH' else chunk.end_time) for chunk in job.chunks]
+  loudness_fp = MJ.fingerprint(job.mainfile_source, ranges, MA.LOUDNESS_VERSION)
+  if (record := job.journal.get('loudness', loudness_fp)) is None:
+    # One decode of the whole video for every chunk, and the video as the album
+    print(f"-- Measuring loudness of {job.url}")
+    record = {'tags': MA.replaygain_tags(MA.compute_loudness_profile(job.mainfile), ranges)}
+    job.journal.mark_done('loudness', loudness_fp, record)
+  for chunk, gain_tags in zip(job.chunks, record['tags']):
+    chunk.gain_tags = gain_tags
+
+# A cut is (output file path, begin time, end time), with times in seconds. An end time of None means up to the end.
+Cut = tuple[str, float, Optional[float]]
+
+def cut_range_args(begin_time: float, end_time: Optional[float]) -> dict:
+  if end_time is None:
+    return {'ss': begin_time}
+  return {'ss': begin_time, 't': end_time - begin_time}
+
+def split_per_chunk(audio_filepath: str, cuts: list[Cut], on_cut_done: Callable[[Cut], None]):
+  for cut in cuts:
+    chunk_filepath, begin_time, end_time = cut
+    # open a file, from `ss`, for duration `t`
+    stream = ffmpeg.input(audio_filepath, **cut_range_args(begin_time, end_time))
+    # output to named file
+    stream = ffmpeg.output(stream, chunk_filepath, vcodec="copy", acodec="copy")
+    # this was to make trial and error easier
+    stream = ffmpeg.overwrite_output(stream)
+
+    # and actually run
+    run_ffmpeg(stream)
+    on_cut_done(cut)
+
+def split_single_pass(audio_filepath: str, cuts: list[Cut], on_cut_done: Callable[[Cut], None]):
+  if not cuts:
+    return
+  # One ffmpeg process with an output per chunk: the input is opened, probed and demuxed only once.
+  # With `ss` and `t` as output options, each output just drops the packets outside of its range.
+  source = ffmpeg.input(audio_filepath)
+  outputs = [
+    ffmpeg.output(source, chunk_filepath, **cut_range_args(begin_time, end_time), vcodec="copy", acodec="copy")
+    for chunk_filepath, begin_time, end_time in cuts]
+  stream = ffmpeg.merge_outputs(*outputs)
+  stream = ffmpeg.overwrite_output(stream)
+  run_ffmpeg(stream)
+  for cut in cuts:
+    on_cut_done(cut)
+
+# Encoders for chunks cut in precise mode, by codec of the input. Other codecs get the output format's default encoder.
+PRECISE_ENCODERS = {
+  'opus': 'libopus',
+  'vorbis': 'libvorbis',
+  'aac': 'aac',
+  'mp3': 'libmp3lame',
+  'flac': 'flac',
+}
 
-    for chunk in job.chunks:
-      chunk_filepath = os.path.join(output_prefix, chunk.out_basename + job.mainfile_ext)
-      # Save absolute file path for later passes
-      chunk.out_filepath = os.path.abspath(chunk_filepath)
+# How far off (in samples) a fully re-encoded chunk may come out, by codec: the container's duration counts some of
+# the encoder's priming and padding for the lossy ones
+PRECISE_TOLERANCES = {
+  'vorbis': 2048,
+  'aac': 2048,
+  'mp3': 2304,
+  'opus': 312 + 960,
+  'flac': 0,
+}
+# For the other codecs, in seconds
+PRECISE_TOLERANCE = 0.001
+
+# Opus chunks in Ogg don't get re-encoded at all: their packets are copied, and trimmed to the exact sample by the
+# container itself, through the pre-skip at the start and the last page's granule position at the end
+OGG_EXTS = {'.ogg', '.opus'}
+# Packets copied ahead of a chunk's start, and skipped as part of the pre-skip, so that the decoder has settled into the
+# same state it'd be in at that point of the whole file. After 0.4s, what's left differs by less than float rounding.
+OPUS_PRE_ROLL = 24000
+
+def probe_audio_duration(audio_filepath: str) -> float:
+  probe = ffmpeg.probe(audio_filepath, select_streams='a:0')
+  return float(probe['streams'][0].get('duration') or probe['format']['duration'])
+
+def check_cut_length(chunk_filepath: str, expected_seconds: float, stream_info: dict):
+  sample_rate = int(stream_info['sample_rate'])
+  expected = round(expected_seconds * sample_rate)
+  actual = round(probe_audio_duration(chunk_filepath) * sample_rate)
+  tolerance = PRECISE_TOLERANCES.get(stream_info['codec_name'], PRECISE_TOLERANCE * sample_rate)
+  if abs(actual - expected) > tolerance:
+    # The chunk is still usable, the other chunks of the job shouldn't be held up by it
+    print(f"-- [WARNING] {chunk_filepath} is {actual} samples long instead of {expected}")
+
+def cut_opus(source_filepath: str, boundaries: list[int], source_length: int, cut: Cut) -> bool:
+  """Copy an Ogg Opus chunk, returns False if it lies within a single packet (which ffmpeg fails to trim at both ends)."""
+  chunk_filepath, begin_time, end_time = cut
+  begin = round(begin_time * MOO.SAMPLE_RATE)
+  end = source_length if end_time is None else min(round(end_time * MOO.SAMPLE_RATE), source_length)
+  if bisect.bisect_right(boundaries, begin) >= bisect.bisect_left(boundaries, end):
+    return False
+  # The writer checks that the packets reach the requested end, and trims them to it
+  MOO.write_excerpt(source_filepath, chunk_filepath, begin, end, OPUS_PRE_ROLL)
+  return True
+
+def split_precise(audio_filepath: str, cuts: list[Cut], on_cut_done: Callable[[Cut], None]):
+  # Stream copying alone snaps the cuts to packet boundaries. Opus chunks in Ogg get trimmed by the container instead,
+  # see cut_opus(), the rest are re-encoded as a whole, with the input decoded from the exact sample they start at.
+  if not cuts:
+    return
+  probe = ffmpeg.probe(audio_filepath, select_streams='a:0')
+  stream_info = probe['streams'][0]
+  input_duration = float(stream_info.get('duration') or probe['format']['duration'])
+  bit_rate = stream_info.get('bit_rate') or probe['format'].get('bit_rate')
+  encode_args = {'ar': int(stream_info['sample_rate'])}
+  if (encoder := PRECISE_ENCODERS.get(stream_info['codec_name'])) is not None:
+    encode_args['acodec'] = encoder
+  if bit_rate is not None:
+    encode_args['audio_bitrate'] = bit_rate
+  copy_opus = stream_info['codec_name'] == 'opus'
+
+  with tempfile.TemporaryDirectory(prefix='$precise-', dir=os.path.dirname(audio_filepath)) as tmp_dir:
+    source_filepath = audio_filepath
+    boundaries = None
+    for cut in cuts:
+      chunk_filepath, begin_time, end_time = cut
+      if copy_opus and os.path.splitext(chunk_filepath)[1] in OGG_EXTS:
+        if boundaries is None:
+          if os.path.splitext(audio_filepath)[1] not in OGG_EXTS:
+            # e.g. a .webm, its packets are read back from Ogg
+            source_filepath = os.path.join(tmp_dir, 'source.ogg')
+            run_ffmpeg(ffmpeg.overwrite_output(ffmpeg.output(ffmpeg.input(audio_filepath).audio, source_filepath, acodec='copy')))
+          boundaries = MOO.read_boundaries(source_filepath)
+        # The last packet's padding isn't audio
+        source_length = min(boundaries[-1], round(input_duration * MOO.SAMPLE_RATE))
+        if cut_opus(source_filepath, boundaries, source_length, cut):
+          on_cut_done(cut)
+          continue
+
+      stream = ffmpeg.input(audio_filepath, **cut_range_args(begin_time, end_time)).audio
+      run_ffmpeg(ffmpeg.overwrite_output(ffmpeg.output(stream, chunk_filepath, **encode_args)))
+      end_time = input_duration if end_time is None else min(end_time, input_duration)
+      check_cut_length(chunk_filepath, end_time - begin_time, stream_info)
+      on_cut_done(cut)
+
+SPLIT_MODES = {
+  'single-pass': split_single_pass,
+  'per-chunk': split_per_chunk,
+  'precise': split_precise,
+}
 
-      begin_time = chunk.begin_time
-      end_time = chunk.end_time
-      if end_time == 'VIDEOLENGTH' and begin_time == 0:
-        # This is a whole video chunk
-        shutil.copyfile(audio_filepath, chunk_filepath)
-        continue
-      elif end_time == 'VIDEOLENGTH':
-        end_time = job.video_info['duration']
+def remove_stale_outputs(job: Job, manifest: MJ.OutputManifest):
+  # Outputs of chunks that were renamed or removed from the command file since the last run
+  current_outputs = [chunk.out_filepath for chunk in job.chunks]
+  if (record := job.journal.steps.get('outputs')) is not None:
+    for filepath in set(record['data']['files']) - set(current_outputs):
+      # Only delete what's still exactly the file we produced
+      if manifest.is_intact(filepath):
+        print(f"-- Removing stale output {filepath}")
+        os.remove(filepath)
+        manifest.forget(filepath)
+  job.journal.mark_done('outputs', '', {'files': current_outputs})
 
-      # open a file, from `ss`, for duration `t`
-      stream = ffmpeg.input(audio_filepath, ss=begin_time, t=(end_time - begin_time))
-      # output to named file
-      stream = ffmpeg.output(stream, chunk_filepath, vcodec="copy", acodec="copy")
-      # this was to make trial and error easier
-      stream = ffmpeg.overwrite_output(stream)
+# Pass 6
+def split_job(job: Job, output_dir: Optional[os.path], store: MBS.BlobStore, split_mode: str = 'single-pass', force: bool = False):
+  output_prefix = output_dir if output_dir is not None else job.wksp_dir
+  audio_filepath = job.mainfile
+  # Chunk fingerprints live next to the outputs, they describe those files and not the workspace
+  manifest = MJ.OutputManifest.of_dir(output_prefix)
+
+  cuts = []
+  split_fps = {}
+  for chunk in job.chunks:
+    chunk_filepath = os.path.join(output_prefix, chunk.out_basename + job.out_ext)
+    # Save absolute file path for later passes
+    chunk.out_filepath = os.path.abspath(chunk_filepath)
+
+    begin_time = chunk.begin_time
+    end_time = chunk.end_time
+    if end_time == 'VIDEOLENGTH':
+      end_time = job.video_info['duration']
+
+    # The copying modes all cut the same, only precise cuts differ
+    precise = ['precise'] if split_mode == 'precise' else []
+    chunk.split_fingerprint = MJ.fingerprint(job.mainfile_source, begin_time, end_time, *precise)
+    if not force and manifest.check(chunk_filepath, 'split', chunk.split_fingerprint):
+      continue
 
-      # and actually run
-      ffmpeg.run(stream)
+    if chunk.end_time == 'VIDEOLENGTH' and begin_time == 0:
+      if job.out_ext == job.mainfile_ext:
+        # This is a whole video chunk. It gets tagged later, so it must not share the blob's inode.
+        store.link(audio_filepath, chunk_filepath, allow_hardlink=False)
+        manifest.record(chunk_filepath, 'split', chunk.split_fingerprint, reset=True)
+        continue
+      # Still needs the container changed, i.e. a plain remux
+      end_time = None
+    cuts.append((chunk_filepath, begin_time, end_time))
+    split_fps[chunk_filepath] = chunk.split_fingerprint
+
+  remove_stale_outputs(job, manifest)
+
+  if cuts:
+    print(f"-- Cutting {len(cuts)} of {len(job.chunks)} chunks of {job.url}")
+  # A freshly cut file has no tags, hence the reset
+  SPLIT_MODES[split_mode](audio_filepath, cuts, lambda cut: manifest.record(cut[0], 'split', split_fps[cut[0]], reset=True))
+  manifest.save()
+
+def resolve_tag_ops(job: Job, idx: int, chunk: Chunk) -> list[tuple[str, str | int]]:
+  tags = []
+  for op in itertools.chain(job.tag_ops, chunk.tag_ops):
+    name = op.name
+    value = op.value
+    if value == '$INDEX':
+      value = idx + 1
+    elif value == '$FILENAME':
+      value = chunk.out_basename + job.out_ext
+    elif value == '$FILENAME_ORIG':
+      print('-- [WARN] $FILENAME_ORIG is deprecated, use $CHUNK_NAME instead')
+      value = chunk.chunk_name
+    elif value == '$CHUNK_NAME':
+      value = chunk.chunk_name
+    elif value == '$PLAYLIST_INDEX':
+      if job.playlist_index is None:
+        raise RuntimeError(f"$PLAYLIST_INDEX used on {job.url}, which isn't a playlist entry")
+      value = job.playlist_index + 1
+    tags.append((name, value))
+  if chunk.gain_tags is not None:
+    for name, value in chunk.gain_tags.items():
+      tags.append((MT.RAW_TAG_PREFIX + name, value))
+  return tags
 
 # Pass 7
-def pass_apply_tag_ops(input_struct: InputStruct):
-  for job in input_struct.job_list:
-    for idx, chunk in enumerate(job.chunks):
-      f = music_tag.load_file(chunk.out_filepath)
-
-      for op in itertools.chain(job.tag_ops, chunk.tag_ops):
-        name = op.name
-        value = op.value
-        if value == '$INDEX':
-          value = idx + 1
-        elif value == '$FILENAME':
-          value = chunk.out_basename + job.mainfile_ext
-        elif value == '$FILENAME_ORIG':
-          print('-- [WARN] $FILENAME_ORIG is deprecated, use $CHUNK_NAME instead')
-          value = chunk.chunk_name
-        elif value == '$CHUNK_NAME':
-          value = chunk.chunk_name
-        f[name] = value
-
-      f.save()
+def tag_job(job: Job, tag_jobs: int = 4):
+  pending = []
+  for idx, chunk in enumerate(job.chunks):
+    manifest = MJ.OutputManifest.of_dir(os.path.dirname(chunk.out_filepath))
+    tags = resolve_tag_ops(job, idx, chunk)
+    tag_fp = MJ.fingerprint(chunk.split_fingerprint, tags)
+    if manifest.check(chunk.out_filepath, 'tag', tag_fp):
+      continue
+    # Several ops may target the same tag, the last one wins, same as assigning them in order
+    pending.append((MT.TagWrite(chunk.out_filepath, dict(tags)), manifest, tag_fp))
+
+  writes = [write for write, _, _ in pending]
+  failed = []
+  for (write, manifest, tag_fp), result in zip(pending, MT.write_tags_batch(writes, tag_jobs)):
+    if result.error is not None:
+      print(f"-- [ERROR] Failed to tag {result.path}: {result.error!r}")
+      failed.append(result)
+      continue
+    manifest.record(write.path, 'tag', tag_fp)
+  for manifest in {manifest for _, manifest, _ in pending}:
+    manifest.save()
+  if failed:
+    raise RuntimeError(f"Failed to tag {len(failed)} chunks")
+
+@dataclass
+class Stage():
+  name: str
+  # Returning a list of jobs passes those on to the next stage, instead of the job itself
+  fn: Callable[[Job], Optional[list[Job]]]
+  num_workers: int = 1
+
+# Marks the end of the job stream inside the pipeline queues
+_END_OF_JOBS = object()
+
+def run_pipeline(jobs, stages: list[Stage], queue_size: int) -> list[tuple[Job, str, Exception]]:
+  """Stream jobs through stages, each stage running on its own set of worker threads.
+
+  Returns the failed jobs, as (job, stage name, exception).
+  """
+  # Stages are connected by bounded queues, so e.g. downloads can't run arbitrarily far ahead of splitting.
+  # Anything worse than an Exception (e.g. Ctrl-C) drains the pipeline without running any more jobs, and is raised
+  # again once every worker has exited.
+  queues = [queue.Queue(maxsize=max(queue_size, 1)) for _ in stages]
+  failures = []
+  failures_lock = threading.Lock()
+  aborts = []
+
+  def worker(stage_idx: int):
+    stage = stages[stage_idx]
+    in_queue = queues[stage_idx]
+    out_queue = queues[stage_idx + 1] if stage_idx + 1 < len(stages) else None
+    while (job := in_queue.get()) is not _END_OF_JOBS:
+      if aborts:
+        # Keep taking jobs, so that neither the stage before nor the shutdown blocks on a full queue
+        continue
+      try:
+        replacements = stage.fn(job)
+      except Exception as e:
+        print(f"-- [ERROR] Job {job.url} failed during {stage.name}: {e!r}")
+        with failures_lock:
+          failures.append((job, stage.name, e))
+        continue
+      except BaseException as e:
+        print(f"-- [ERROR] Aborting, job {job.url} raised {e!r} during {stage.name}")
+        with failures_lock:
+          aborts.append(e)
+        continue
+      for out_job in [job] if replacements is None else replacements:
+        if out_queue is not None:
+          out_queue.put(out_job)
+        else:
+          print(f"-- Finished {out_job.url}")
+
+  stage_threads = []
+  for stage_idx, stage in enumerate(stages):
+    threads = [threading.Thread(target=worker, args=(stage_idx,), name=f"{stage.name}-{i}", daemon=True)
+               for i in range(max(stage.num_workers, 1))]
+    for t in threads:
+      t.start()
+    stage_threads.append(threads)
+
+  try:
+    # jobs may be a lazy parser, whose errors come out of here
+    for job in jobs:
+      if aborts:
+        break
+      queues[0].put(job)
+  except Exception:
+    # The jobs before a bad one still get finished
+    raise
+  except BaseException as e:
+    # e.g. Ctrl-C while blocked on a full queue, which only ever lands on the main thread
+    with failures_lock:
+      aborts.append(e)
+    raise
+  finally:
+    # Shut down stage by stage: once every worker of a stage has exited, nothing more can reach the next one.
+    # Jobs already in the pipeline get finished either way.
+    for q, threads in zip(queues, stage_threads):
+      for _ in threads:
+        q.put(_END_OF_JOBS)
+      for t in threads:
+        t.join()
+
+  if aborts:
+    raise aborts[0]
+  return failures
 
 def parse_line_with_prefix(line, prefix):
   if line.startswith(prefix):
@@ -273,14 +870,26 @@ TAG_OP_PREFIX = {
   'S': 3, #Section
 }
 
-def parse_input_file(f) -> InputStruct:
-  input_struct = InputStruct()
-  job_list = input_struct.job_list
+class InputFileError(RuntimeError):
+  def __init__(self, filename: str, line_num: int, msg: str):
+    super().__init__(f"{filename}:{line_num}: {msg}")
+    self.filename = filename
+    self.line_num = line_num
+
+def iter_input_file(f, filename: str = '<input>') -> Iterator[Job]:
+  """Parse a command file, yielding each job as soon as its `---` separator (or the end of file) is reached.
 
+  Jobs come out with pass 1 already applied, so that a pipeline can start on
+  the first job while the rest of the file is still being read.
+  """
   curr_job = Job()
   curr_section_beg = 0
 
-  for line in f:
+  def commit_job(job: Job) -> Job:
+    postprocess_job(job)
+    return job
+
+  for line_num, line in enumerate(f, start=1):
     # Skip empty lines
     if not line:
       continue
@@ -294,60 +903,68 @@ def parse_input_file(f) -> InputStruct:
       tag_scope = TAG_OP_PREFIX[indicator]
       line = line[1:]
 
-    if url_str := parse_line_with_prefix(line, "url: "):
-      curr_job.url = url_str.strip()
-    elif chunk_str := parse_line_with_prefix(line, 'chunk: '):
-      tp = chunk_str.strip().split(" ", 2)
-      if len(tp) != 3:
-        raise RuntimeError('chunk string need exactly 3 components: BEGIN_TIME, END_TIME, CHUNK_NAME separated by spaces')
-      chunks = curr_job.chunks
-      chunks.append(Chunk(
-        begin_time=MU.strparse_hms_to_seconds(tp[0]),
-        end_time=parse_unresolved_time(tp[1]),
-        chunk_name=parse_value(tp[2])))
-    elif line.startswith('chunk_by_chapter: true'):
-      curr_job.chunk_by_chapter = True
-    elif ext_str := parse_line_with_prefix(line, 'use_file_extension: '):
-      print('-- [WARN] Directive use_file_extension is now deprecated. Chunks file extension will be automatically extracted from the video info.')
-      #curr_job.use_file_extension = parse_value(ext_str)
-    elif ext_str := parse_line_with_prefix(line, 'prefix: '):
-      curr_job.prefix = parse_value(ext_str)
-    elif ext_str := parse_line_with_prefix(line, 'suffix: '):
-      curr_job.suffix = parse_value(ext_str)
-    elif line.startswith('$$--SECTION BREAK--$$'):
-      curr_section_beg = len(curr_job.chunks)
-    elif ext_str := parse_line_with_prefix(line, 'tag('):
-      (tag_names, _, ext_str) = ext_str.partition(')')
-      tag_value = parse_value(ext_str.removeprefix(': '))
-
-      tag_lists = []
-      if tag_scope == 1:
-        tag_lists.append(curr_job.tag_ops)
-      elif tag_scope == 2:
-        tag_lists.append(curr_job.chunks[-1].tag_ops)
-      elif tag_scope == 3:
-        for i in range(curr_section_beg, len(curr_job.chunks)):
-          tag_lists.append(curr_job.chunks[i].tag_ops)
-      else:
-        print('Error: tag scope not specified')
-        sys.exit(-1)
-
-      for tag_name in tag_names.split(','):
-        for tag_list in tag_lists:
-          tag_list.append(TagOp(
-            name=tag_name,
-            value=tag_value))
-    elif line.startswith('---') and curr_job.url:
-      # Separator, commit curr_job
-      job_list.append(curr_job)
-      curr_section_beg = 0
-      curr_job = Job()
+    try:
+      if url_str := parse_line_with_prefix(line, "url: "):
+        curr_job.url = url_str.strip()
+      elif chunk_str := parse_line_with_prefix(line, 'chunk: '):
+        tp = chunk_str.strip().split(" ", 2)
+        if len(tp) != 3:
+          raise InputFileError(filename, line_num, 'chunk string need exactly 3 components: BEGIN_TIME, END_TIME, CHUNK_NAME separated by spaces')
+        chunks = curr_job.chunks
+        chunks.append(Chunk(
+          begin_time=MU.strparse_hms_to_seconds(tp[0]),
+          end_time=parse_unresolved_time(tp[1]),
+          chunk_name=parse_value(tp[2])))
+      elif line.startswith('chunk_by_chapter: true'):
+        curr_job.chunk_by_chapter = True
+      elif ext_str := parse_line_with_prefix(line, 'use_file_extension: '):
+        print(f'-- [WARN] {filename}:{line_num}: Directive use_file_extension is now deprecated. Chunks file extension will be automatically extracted from the video info.')
+        #curr_job.use_file_extension = parse_value(ext_str)
+      elif ext_str := parse_line_with_prefix(line, 'prefix: '):
+        curr_job.prefix = parse_value(ext_str)
+      elif ext_str := parse_line_with_prefix(line, 'suffix: '):
+        curr_job.suffix = parse_value(ext_str)
+      elif line.startswith('$$--SECTION BREAK--$$'):
+        curr_section_beg = len(curr_job.chunks)
+      elif ext_str := parse_line_with_prefix(line, 'tag('):
+        (tag_names, _, ext_str) = ext_str.partition(')')
+        tag_value = parse_value(ext_str.removeprefix(': '))
+
+        tag_lists = []
+        if tag_scope == 1:
+          tag_lists.append(curr_job.tag_ops)
+        elif tag_scope == 2:
+          if not curr_job.chunks:
+            raise InputFileError(filename, line_num, '^tag with no chunk before it')
+          tag_lists.append(curr_job.chunks[-1].tag_ops)
+        elif tag_scope == 3:
+          for i in range(curr_section_beg, len(curr_job.chunks)):
+            tag_lists.append(curr_job.chunks[i].tag_ops)
+        else:
+          raise InputFileError(filename, line_num, 'tag scope not specified, prefix the directive with one of ' + ' '.join(TAG_OP_PREFIX))
+
+        for tag_name in tag_names.split(','):
+          # One instance, referenced from every list in scope
+          op = intern_tag_op(tag_name, tag_value)
+          for tag_list in tag_lists:
+            tag_list.append(op)
+      elif line.startswith('---') and curr_job.url:
+        # Separator, commit curr_job
+        yield commit_job(curr_job)
+        curr_section_beg = 0
+        curr_job = Job()
+    except InputFileError:
+      raise
+    except (ValueError, RuntimeError) as e:
+      # e.g. malformed timestamps
+      raise InputFileError(filename, line_num, str(e)) from e
 
   # Commit last job if there is one (we assume a job to be well-formed only if at least an url is present)
   if curr_job.url:
-    job_list.append(curr_job)
+    yield commit_job(curr_job)
 
-  return input_struct
+def parse_input_file(f, filename: str = '<input>') -> InputStruct:
+  return InputStruct(job_list=list(iter_input_file(f, filename)))
 
 # Example YAML input format
 """
@@ -362,10 +979,14 @@ chunks:
   segment: "16:02 NEXTCHUNK"
 - filename: "Der Schwan von Tuonela"
   segment: "30:50 NEXTCHUNK"
+  # Tags of a single chunk, like ^tag in the line based format
+  tags:
+  - type: comment
+    value: "Tuonelan joutsen"
 - filename: "Lemminkäinen zieht heimwärts"
   segment: "39:05 NEXTCHUNK"
 tags:
-- type: author
+- type: artist,composer
   scope: all
   value: "Jean Sibelius"
 - type: album
@@ -379,8 +1000,126 @@ tags:
 url: "another vidoe"
 prefix: "..."
 """
-def parse_input_file_yaml(file):
-  pass # TODO
+
+YAML_JOB_KEYS = {'url', 'prefix', 'suffix', 'chunk_by_chapter', 'chunks', 'tags'}
+YAML_CHUNK_KEYS = {'filename', 'segment', 'tags'}
+YAML_TAG_KEYS = {'type', 'scope', 'value'}
+
+def yaml_node_line(node, path: list) -> int:
+  """1-based line of the node at path (dict keys and list indices) inside a document node, or as close as it gets."""
+  for key in path:
+    children = []
+    if isinstance(node.value, list):
+      if isinstance(key, int):
+        children = node.value[key:key + 1]
+      else:
+        children = [v for k, v in node.value if isinstance(k.value, str) and k.value == key]
+    if not children:
+      break
+    node = children[0]
+  return node.start_mark.line + 1
+
+class YamlSchemaError(Exception):
+  def __init__(self, path: list, msg: str):
+    super().__init__(msg)
+    self.path = path
+
+def yaml_expect(value, expected_type, path: list):
+  if not isinstance(value, expected_type):
+    raise YamlSchemaError(path, f"expected {getattr(expected_type, '__name__', expected_type)}, got {type(value).__name__}")
+  return value
+
+def yaml_parse_tags(tags, path: list, allow_scope: bool) -> list[TagOp]:
+  tag_ops = []
+  for i, tag in enumerate(yaml_expect(tags, list, path)):
+    tag_path = path + [i]
+    yaml_expect(tag, dict, tag_path)
+    if unknown := set(tag) - YAML_TAG_KEYS:
+      raise YamlSchemaError(tag_path, f"unknown keys {sorted(unknown)}")
+    if 'type' not in tag or 'value' not in tag:
+      raise YamlSchemaError(tag_path, 'a tag needs both a type and a value')
+    scope = tag.get('scope', 'all' if allow_scope else None)
+    if allow_scope and scope != 'all':
+      raise YamlSchemaError(tag_path + ['scope'], "only 'all' is supported for job tags, put chunk tags under the chunk")
+    if not allow_scope and scope is not None:
+      raise YamlSchemaError(tag_path + ['scope'], 'chunk tags apply to their chunk, they take no scope')
+
+    value = tag['value']
+    if isinstance(value, dict):
+      if set(value) != {'macro'}:
+        raise YamlSchemaError(tag_path + ['value'], 'a structured value must be exactly {macro: ...}')
+      value = value['macro']
+    value = '' if value is None else str(value)
+
+    tag_names = tag['type']
+    if isinstance(tag_names, str):
+      tag_names = tag_names.split(',')
+    for tag_name in yaml_expect(tag_names, list, tag_path + ['type']):
+      tag_ops.append(intern_tag_op(str(tag_name).strip(), value))
+  return tag_ops
+
+def yaml_parse_job(doc, path: list) -> Job:
+  yaml_expect(doc, dict, path)
+  if unknown := set(doc) - YAML_JOB_KEYS:
+    raise YamlSchemaError(path, f"unknown keys {sorted(unknown)}")
+  if 'url' not in doc:
+    raise YamlSchemaError(path, 'a job needs an url')
+
+  job = Job(
+    url=yaml_expect(doc['url'], str, ['url']).strip(),
+    chunk_by_chapter=yaml_expect(doc.get('chunk_by_chapter', False), bool, ['chunk_by_chapter']),
+    prefix=yaml_expect(doc.get('prefix'), (str, type(None)), ['prefix']),
+    suffix=yaml_expect(doc.get('suffix'), (str, type(None)), ['suffix']),
+    tag_ops=yaml_parse_tags(doc.get('tags', []), ['tags'], allow_scope=True))
+
+  for i, chunk in enumerate(yaml_expect(doc.get('chunks', []), list, ['chunks'])):
+    chunk_path = ['chunks', i]
+    yaml_expect(chunk, dict, chunk_path)
+    if unknown := set(chunk) - YAML_CHUNK_KEYS:
+      raise YamlSchemaError(chunk_path, f"unknown keys {sorted(unknown)}")
+    segment = yaml_expect(chunk.get('segment'), str, chunk_path + ['segment']).split()
+    if len(segment) != 2:
+      raise YamlSchemaError(chunk_path + ['segment'], 'segment needs exactly 2 components: BEGIN_TIME END_TIME')
+    try:
+      begin_time = MU.strparse_hms_to_seconds(segment[0])
+      end_time = parse_unresolved_time(segment[1])
+    except (ValueError, RuntimeError) as e:
+      raise YamlSchemaError(chunk_path + ['segment'], str(e)) from e
+    job.chunks.append(Chunk(
+      begin_time=begin_time,
+      end_time=end_time,
+      chunk_name=str(yaml_expect(chunk.get('filename'), (str, int, float), chunk_path + ['filename'])),
+      tag_ops=yaml_parse_tags(chunk.get('tags', []), chunk_path + ['tags'], allow_scope=False)))
+  return job
+
+def iter_input_file_yaml(f, filename: str = '<input>') -> Iterator[Job]:
+  """YAML counterpart of iter_input_file(), one job per YAML document."""
+  import yaml
+  # The C loader is several times faster, but only there if PyYAML was built against libyaml
+  Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+  loader = Loader(f)
+  try:
+    while loader.check_node():
+      node = loader.get_node()
+      doc = loader.construct_document(node)
+      if doc is None:
+        # Empty document, e.g. a trailing ---
+        continue
+      try:
+        job = yaml_parse_job(doc, [])
+      except YamlSchemaError as e:
+        location = ''.join(f"[{k}]" if isinstance(k, int) else f".{k}" for k in e.path).lstrip('.')
+        raise InputFileError(filename, yaml_node_line(node, e.path), f"{location or 'job'}: {e}") from e
+      postprocess_job(job)
+      yield job
+  except yaml.MarkedYAMLError as e:
+    raise InputFileError(filename, e.problem_mark.line + 1 if e.problem_mark else 0, e.problem or str(e)) from e
+  finally:
+    loader.dispose()
+
+def is_yaml_input_file(path: str) -> bool:
+  _, ext = os.path.splitext(path)
+  return ext in ('.yml', '.yaml')
 
 def dump_input_struct(input_struct: InputStruct):
   # TODO other fields
@@ -411,8 +1150,103 @@ def dump_input_struct(input_struct: InputStruct):
       print(f"- name: {tag_op.name}")
       print(f"  value: \"{tag_op.value}\"")
 
+# Bump whenever Job/Chunk/TagOp or the passes change in a way that makes old compiled files wrong
+COMPILED_FORMAT_VERSION = 2
+
+def job_to_dict(job: Job) -> dict:
+  # Only what the parser and passes 1-3 produce, runtime state (journal, mainfile...) isn't worth keeping
+  return {
+    'url': job.url,
+    'chunk_by_chapter': job.chunk_by_chapter,
+    'prefix': job.prefix,
+    'suffix': job.suffix,
+    'wksp_id': job.wksp_id,
+    'wksp_dir': job.wksp_dir,
+    'video_info': job.video_info,
+    'playlist_index': job.playlist_index,
+    'tag_ops': [asdict(op) for op in job.tag_ops],
+    'chunks': [{
+      'begin_time': chunk.begin_time,
+      'end_time': chunk.end_time,
+      'chunk_name': chunk.chunk_name,
+      'out_basename': chunk.out_basename,
+      'tag_ops': [asdict(op) for op in chunk.tag_ops],
+    } for chunk in job.chunks],
+  }
+
+def job_from_dict(d: dict) -> Job:
+  return Job(
+    url=d['url'],
+    chunk_by_chapter=d['chunk_by_chapter'],
+    prefix=d['prefix'],
+    suffix=d['suffix'],
+    wksp_id=d['wksp_id'],
+    wksp_dir=d['wksp_dir'],
+    video_info=d['video_info'],
+    playlist_index=d['playlist_index'],
+    tag_ops=[intern_tag_op(**op) for op in d['tag_ops']],
+    chunks=[Chunk(
+      begin_time=c['begin_time'],
+      end_time=c['end_time'],
+      chunk_name=c['chunk_name'],
+      out_basename=c['out_basename'],
+      tag_ops=[intern_tag_op(**op) for op in c['tag_ops']]) for c in d['chunks']])
+
+class CompiledCommandFile():
+  """Cache of a command file's jobs, keyed by the hash of the file's content."""
+
+  # 'parsed' skips pass 1, 'expanded' also skips passes 2 and 3, and embeds video info so it gets the same TTL
+  STAGES = ['parsed', 'expanded']
+
+  def __init__(self, compiled_dir: str, content: bytes, input_file_path: str):
+    os.makedirs(compiled_dir, exist_ok=True)
+    content_hash = hashlib.sha256(content).hexdigest()
+    self.path_base = os.path.join(compiled_dir, f"{content_hash}-v{COMPILED_FORMAT_VERSION}")
+    # Names the path_base last saved for the command file at this path, the previous one gets removed once it changes
+    path_hash = hashlib.md5(os.path.abspath(input_file_path).encode('utf-8')).hexdigest()
+    self.latest_path = os.path.join(compiled_dir, f"{path_hash}.latest")
+
+  def load(self, stage: str, max_age: Optional[float] = None) -> Optional[list[Job]]:
+    path = f"{self.path_base}.{stage}.json"
+    try:
+      if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+        return None
+      with open(path, 'r') as f:
+        return [job_from_dict(d) for d in json.load(f)]
+    except FileNotFoundError:
+      return None
+
+  def save(self, stage: str, job_dicts: list[dict]):
+    MU.atomic_write_json(f"{self.path_base}.{stage}.json", job_dicts)
+    self._prune_previous()
+
+  def _prune_previous(self):
+    try:
+      with open(self.latest_path, 'r') as f:
+        previous_base = os.path.join(os.path.dirname(self.latest_path), json.load(f))
+    except FileNotFoundError:
+      previous_base = None
+    if previous_base == self.path_base:
+      return
+    if previous_base is not None:
+      # Another command file with the very same content would share these, it just gets recompiled
+      for stage in self.STAGES:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(f"{previous_base}.{stage}.json")
+    MU.atomic_write_json(self.latest_path, os.path.basename(self.path_base))
+
+def restore_workspace(job: Job):
+  # The work dir might have been cleaned since the file was compiled
+  os.makedirs(job.wksp_dir, exist_ok=True)
+  info_file_path = os.path.join(job.wksp_dir, '$info.json')
+  if not os.path.isfile(info_file_path):
+    with open(info_file_path, 'w') as info_file:
+      info_file.write(json.dumps(job.video_info))
+
 def clean_outputs(work_dir):
   for dirpath, dnames, fnames in os.walk(work_dir):
+    # Skip internal directories, e.g. the audio store
+    dnames[:] = [d for d in dnames if not d.startswith('$')]
     for f in fnames:
       if not f.startswith('$'):
         fpath = os.path.join(dirpath, f)
@@ -433,15 +1267,33 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(prog='process_music.py', description='Music downloader and splicer')
   parser.add_argument('command_file', nargs='?')
   parser.add_argument('--reuse', help='Directory to search for existing video files. File names must contain the video ID.')
+  parser.add_argument('--build-reuse-index', action='store_true', help='Rescan the whole --reuse directory, instead of only the files added since the last run.')
   parser.add_argument('--work-dir', default='/tmp/00-myscript-process_music/')
   parser.add_argument('--output-dir', help='Directory to place output (sliced) audio files. If relative, it is relative to --work-dir. Omit to use the same directory as work dir.')
+  parser.add_argument('--recompile', action='store_true', help='Parse the command file and resolve video info again, even if it was already compiled.')
+  parser.add_argument('-f', '--force', action='store_true', help='Ignore the checkpoint journals and output fingerprints, re-split and re-tag every chunk.')
   parser.add_argument('-y', '--always-yes', action='store_true', help='Skip all yes/no prompts.')
   # It's much cleaner, logical, and intuitive if we had `-c outputs` and `-c everything`, but that's not as ergonomic for an experience user
   parser.add_argument('-c', '--clean-outputs', action='store_true')
   parser.add_argument('-C', '--clean-everything', action='store_true')
   parser.add_argument('--format', default='bestaudio')
+  parser.add_argument('--info-cache', help='SQLite database to cache video info in. Defaults to a file inside --work-dir.')
+  parser.add_argument('--info-ttl', type=float, default=7 * 24, help='Hours before cached video info is refreshed.')
+  parser.add_argument('--info-stale-ttl', type=float, default=30 * 24, help='Hours past --info-ttl during which cached video info is still used, while being refreshed in the background.')
+  parser.add_argument('--extract-jobs', type=int, default=8, help='Number of videos to extract info of concurrently.')
+  parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of jobs (videos) to download concurrently.')
+  parser.add_argument('--cpu-jobs', type=int, default=os.cpu_count() or 1, help='Number of jobs to split and tag concurrently.')
+  parser.add_argument('--split-mode', default='single-pass', choices=list(SPLIT_MODES), help='single-pass cuts all chunks of a video with one ffmpeg invocation, per-chunk runs ffmpeg once for each chunk. Both snap the cuts to the nearest packets, precise cuts at the exact sample: Opus chunks in Ogg are still copied and get trimmed by the container, other codecs are re-encoded.')
+  parser.add_argument('--precise', action='store_true', help='Same as --split-mode precise.')
+  parser.add_argument('--snap-boundaries', type=float, metavar='SECONDS', help='Move chunk boundaries to the nearest silence or applause at most this many seconds away. Needs numpy.')
+  parser.add_argument('--auto-chunks', action='store_true', help='Split videos without any chunks at the silences and applause between pieces. Needs numpy.')
+  parser.add_argument('--gap-db', type=float, default=-40.0, help='Loudness (dBFS) below which audio counts as silence for --snap-boundaries and --auto-chunks.')
+  parser.add_argument('--replaygain', action='store_true', help='Tag chunks with their ReplayGain (EBU R128) track gain, and the whole video as the album. Needs numpy.')
+  parser.add_argument('--queue-size', type=int, default=8, help='Maximum number of jobs waiting between two pipeline stages.')
 
   args = parser.parse_args()
+  if args.precise:
+    args.split_mode = 'precise'
 
   if args.clean_everything:
     print(f'-- Cleaning everything in output directory {args.work_dir}')
@@ -450,65 +1302,139 @@ if __name__ == '__main__':
     print(f'-- Cleaning output files in output directory {args.work_dir}')
     clean_outputs(args.work_dir)
 
+  work_dir = os.path.abspath(args.work_dir)
+  os.makedirs(work_dir, exist_ok=True)
+
+  print(f"-- Reuse dir: {args.reuse}")
+  if args.reuse is not None:
+    reuse_index = MRI.ReuseIndex(os.path.abspath(args.reuse), work_dir, MUSIC_EXTS)
+    if reuse_index.rescan(full=args.build_reuse_index):
+      print(f"-- Indexed {len(reuse_index.files)} files in reuse dir")
+  else:
+    reuse_index = None
+
   if args.command_file:
     input_file_path = os.path.abspath(args.command_file)
   else:
     print('-- No commands file provided, quitting')
     sys.exit()
 
-  print(f"-- Reuse dir: {args.reuse}")
-
-  print(f"-- Using work dir: {args.work_dir}")
-  os.makedirs(args.work_dir, exist_ok=True)
-  os.chdir(args.work_dir)
+  print(f"-- Using work dir: {work_dir}")
 
   if args.output_dir is not None:
-    print(f"-- Using output dir {os.path.abspath(args.output_dir)}")
-    os.makedirs(args.output_dir, exist_ok=True)
+    # Relative to the work dir, if output_dir is absolute join() just returns it
+    output_dir = os.path.join(work_dir, args.output_dir)
+    print(f"-- Using output dir {output_dir}")
+    os.makedirs(output_dir, exist_ok=True)
   else:
+    output_dir = None
     print("-- Using output dir same as each video's work dir")
 
-  dirty_file = 'dirty'
-  if os.path.isfile(dirty_file):
-    print('-- Found working dir in dirty state, likely last run was canceled in the middle.')
-    if args.always_yes or MU.query_yes_no('-- Try to recover?'):
-      print('-- Recovering...')
-      # TODO I wrote this dirty system before everything else, turns out this "recover" logic isn't really needed and it's just a no-op right now
-      #      beacuse we ended up using video ID as the folder name, implicitly having a map inside the filesystem. should we get rid of it?
-    else:
-      print('-- Clearing working dir...')
-      shutil.rmtree(args.work_dir)
-      os.mkdir(args.work_dir)
-      open(dirty_file, 'x').close()
-  else:
-    # Create the file
-    open(dirty_file, 'x').close()
-
   print('\n' * 2)
 
   ydl_opts = {
     'format': args.format,
-    # yt-dlp automatically downloads all playlist items, no need to specify anything
-    # The heuristic for handling playlists is basically a detection for how many files were produced during the download process
+    # Only list the entries of playlists, each one becomes a job of its own and gets its full info resolved separately
     # For B站的分P视频，yt-dlp会自动把它当作playlist处理；合集同理，因此不需要额外的逻辑
-    #'playlist-items': (Something)
+    'extract_flat': 'in_playlist',
   }
+  if args.jobs > 1:
+    # Progress bars of concurrent downloads just garble each other
+    ydl_opts['noprogress'] = True
+
+  stages = [
+    Stage('download', lambda job: download_job(job, reuse_index, ydl_opts, store, args.force), args.jobs),
+    Stage('split', lambda job: split_job(job, output_dir, store, args.split_mode, args.force), args.cpu_jobs),
+    Stage('tag', tag_job, args.cpu_jobs),
+  ]
+  if args.snap_boundaries is not None or args.auto_chunks:
+    stages.insert(1, Stage('analyze', lambda job: analyze_job(job, args.snap_boundaries, args.auto_chunks, args.gap_db), args.cpu_jobs))
+  if args.replaygain:
+    # Right before split, chunk boundaries are final by then
+    stages.insert(len(stages) - 2, Stage('loudness', loudness_job, args.cpu_jobs))
+
+  store = MBS.BlobStore(os.path.join(work_dir, '$store'))
+
+  info_cache_path = args.info_cache if args.info_cache is not None else os.path.join(work_dir, '$info_cache.sqlite3')
+  info_cache = MIC.VideoInfoCache(info_cache_path, ttl=args.info_ttl * 3600, stale_ttl=args.info_stale_ttl * 3600)
+  revalidator = InfoRevalidator(info_cache, ydl_opts)
+  extractor = YdlPool(ydl_opts, args.extract_jobs, name='extract')
+
+  with open(input_file_path, 'rb') as file:
+    content = file.read()
+  compiled = CompiledCommandFile(os.path.join(work_dir, '$compiled'), content, input_file_path)
+  expanded_jobs = None if args.recompile else compiled.load('expanded', max_age=args.info_ttl * 3600)
+  parsed_jobs = None if args.recompile or expanded_jobs is not None else compiled.load('parsed')
+
+  def parse_jobs(collected: list[Job]) -> Iterator[Job]:
+    if parsed_jobs is not None:
+      print('-- Command file unchanged since last run, skipping parsing')
+      collected.extend(parsed_jobs)
+      yield from parsed_jobs
+      return
+    parsed_dicts = []
+    parse_fn = iter_input_file_yaml if is_yaml_input_file(input_file_path) else iter_input_file
+    for job in parse_fn(io.StringIO(content.decode('utf-8')), input_file_path):
+      parsed_dicts.append(job_to_dict(job))
+      collected.append(job)
+      yield job
+    compiled.save('parsed', parsed_dicts)
+
+  with info_cache, revalidator, extractor:
+    try:
+      if expanded_jobs is not None:
+        print('-- Command file and video info unchanged since last run, skipping straight to processing')
+        for job in expanded_jobs:
+          restore_workspace(job)
+        input_struct = InputStruct(job_list=expanded_jobs)
+        prompt_continuation(input_struct, '-- About to process these, continue to download and processing?')
+
+        failures = run_pipeline(input_struct.job_list, stages, args.queue_size)
+      elif args.always_yes:
+        # Nothing to confirm, so jobs can flow into the pipeline while the rest of the file is still being parsed
+        print('-- Processing jobs as they are parsed')
+        streamed_jobs = []
+        entry_jobs_of = {}
+        expanded_dicts = {}
+
+        def resolve_streamed_job(job: Job) -> Optional[list[Job]]:
+          entry_jobs = resolve_job(job, info_cache.get(job.url), info_cache, extractor, revalidator)
+          if entry_jobs is not None:
+            entry_jobs_of[id(job)] = entry_jobs
+          return entry_jobs
+
+        def prepare_and_expand_job(job: Job):
+          if not job.video_info:
+            # A playlist entry, its own info has yet to be resolved
+            resolve_streamed_job(job)
+          prepare_job(job, work_dir)
+          expand_job(job)
+          # Snapshot now, the later stages add runtime state to the job
+          expanded_dicts[id(job)] = job_to_dict(job)
+
+        # Both stages extract info, the second one only for playlist entries
+        stages.insert(0, Stage('resolve', resolve_streamed_job, args.extract_jobs))
+        stages.insert(1, Stage('prepare', prepare_and_expand_job, args.extract_jobs))
+        failures = run_pipeline(parse_jobs(streamed_jobs), stages, args.queue_size)
+        final_jobs = [entry for job in streamed_jobs for entry in entry_jobs_of.get(id(job), [job])]
+        if all(id(job) in expanded_dicts for job in final_jobs):
+          compiled.save('expanded', [expanded_dicts[id(job)] for job in final_jobs])
+      else:
+        input_struct = InputStruct(job_list=list(parse_jobs([])))
+        prompt_continuation(input_struct, '-- About to process these, continue to resolve patterns and video info?')
 
-  with open(input_file_path, 'r') as file, YoutubeDL(ydl_opts) as ydl:
-    input_struct = parse_input_file(file)
-
-    pass_postprocess_info(input_struct)
-    prompt_continuation(input_struct, '-- About to process these, continue to resolve patterns and video info?')
-
-    pass_prepare_yt_dlp(input_struct)
-    pass_video_dependent_info(input_struct)
-    prompt_continuation(input_struct, '-- About to process these, continue to download and processing?')
+        pass_prepare_yt_dlp(input_struct, work_dir, info_cache, extractor, revalidator)
+        pass_video_dependent_info(input_struct)
+        compiled.save('expanded', [job_to_dict(job) for job in input_struct.job_list])
+        prompt_continuation(input_struct, '-- About to process these, continue to download and processing?')
 
-    print('\n' * 2)
+        print('\n' * 2)
 
-    pass_download_yt_dlp(input_struct, args.reuse)
-    pass_split_chunks(input_struct, args.output_dir)
-    pass_apply_tag_ops(input_struct)
+        failures = run_pipeline(input_struct.job_list, stages, args.queue_size)
+    except InputFileError as e:
+      print(f'-- [ERROR] {e}')
+      sys.exit(-1)
 
-  os.remove(dirty_file)
-  os.chdir('..')
+  if failures:
+    print(f'-- {len(failures)} job(s) failed, re-run to resume them')
+    sys.exit(-1)